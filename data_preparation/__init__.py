@@ -1,3 +1,13 @@
 from data_preparation.perpare import PreProcess as PreProcess
 from data_preparation.perpare import PROFTABILITY_TYPE as PROFTABILITY_TYPE
-from data_preparation.perpare import PivotLevels as PivotLevels
\ No newline at end of file
+from data_preparation.perpare import PivotLevels as PivotLevels
+from data_preparation.perpare import WindowSet as WindowSet
+from data_preparation.strategy import StrategyPlan as StrategyPlan
+from data_preparation.strategy import MultiStrategyPlan as MultiStrategyPlan
+from data_preparation.strategy import load_strategies as load_strategies
+from data_preparation.strategy import load_func_defs as load_func_defs
+from data_preparation.tensors import ModelInputs as ModelInputs
+from data_preparation.cache import StageCache as StageCache
+from data_preparation.cache import CachedPreProcess as CachedPreProcess
+from data_preparation.online import OnlineStrategy as OnlineStrategy
+from data_preparation.online import OnlineScorer as OnlineScorer
@@ -0,0 +1,308 @@
+"""Benchmarks of the dataset pipeline with synthetic prices, no database needed.
+
+Usage:
+    python -m data_preparation.benchmark --scales 10x500 50x2500 --output bench.json
+    python -m data_preparation.benchmark --scales 10x500 --compare bench.json
+
+Each stage is timed on every scale (tickers x days). The best of --repeat runs is reported with
+its throughput (rows/s and, for the stages that create windows, windows/s) and the memory used by
+the stage, measured in separate runs so it does not slow down the timed ones:
+
+    peak_bytes            peak of the Python and numpy allocations (tracemalloc)
+    arrow_allocated_bytes bytes allocated by the Arrow memory pool, that tracemalloc does not see
+    rss_peak_bytes        growth of the maximum resident set size of a forked process running the
+                          stage, it includes every allocator (None where fork is not available)
+
+The JSON report can be compared with the report of another commit with --compare.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from typing import Callable, Dict, List, Tuple
+from data_preparation.perpare import PreProcess
+from db_access import ExportToParquet, ParquetStreamExport
+
+DEFAULT_STRATEGY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "strategies_sample.json")
+# Columns of StockHistory that are not used as features
+CATEGORY_COLS = ["market", "segment_id", "subsector_id", "economical_sector_id"]
+
+
+def synthetic_ohlcv(n_tickers: int, n_days: int, seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """Generate random walk prices with the columns of StockHistory, one DataFrame per ticker indexed by dt_price.
+
+    The same seed always gives the same prices.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2010-01-04", periods=n_days)
+    data = {}
+    for i in range(n_tickers):
+        ticker = f"SYN{i:04d}"
+        close = 20 * np.exp(np.cumsum(rng.normal(0.0002, 0.02, n_days)))
+        open_ = close * (1 + rng.normal(0, 0.005, n_days))
+        df = pd.DataFrame({"ticker": ticker,
+                           "dt_price": dates,
+                           "open": open_,
+                           "close": close,
+                           "high": np.maximum(open_, close) * (1 + rng.uniform(0, 0.02, n_days)),
+                           "low": np.minimum(open_, close) * (1 - rng.uniform(0, 0.02, n_days)),
+                           "volume": rng.integers(10**5, 10**7, n_days).astype(float),
+                           "market": "NM",
+                           "segment_id": i % 7,
+                           "subsector_id": i % 11,
+                           "economical_sector_id": i % 5})
+        data[ticker] = df.set_index("dt_price", drop=False)
+
+    return data
+
+
+def _resident_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Without /proc only the growth beyond the previous maximum is measured
+        return _max_resident_bytes()
+
+
+def _max_resident_bytes() -> int:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def rss_growth(func: Callable) -> int:
+    """Growth of the maximum resident set size while func runs in a forked process, None where fork is not available."""
+    if not hasattr(os, "fork"):
+        return None
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            start = _resident_bytes()
+            func()
+            os.write(write_fd, str(max(0, _max_resident_bytes() - start)).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, "r") as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+
+    return int(result) if result else None
+
+
+def measure(func: Callable, repeat: int = 3) -> Tuple[float, Dict[str, int]]:
+    """Return the best wall time of repeat runs of func and the memory used by func (see the module docstring)."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    pool = pa.default_memory_pool()
+    arrow_start = pool.total_bytes_allocated()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, {"peak_bytes": peak,
+                  "arrow_allocated_bytes": pool.total_bytes_allocated() - arrow_start,
+                  "rss_peak_bytes": rss_growth(func)}
+
+
+class PipelineBenchmark:
+    """Times the stages of PreProcess and the parquet exporters on synthetic data."""
+
+    def __init__(self, strategy_file: str = DEFAULT_STRATEGY_FILE, repeat: int = 3, seed: int = 0,
+                 max_scalar_calls: int = 2000) -> None:
+        self.strategy_file = strategy_file
+        self.repeat = repeat
+        self.seed = seed
+        # calculate_proftability is called once per date, it is timed on a sample of the dates
+        self.max_scalar_calls = max_scalar_calls
+        self.pre_process = PreProcess()
+        with open(strategy_file, "r") as f:
+            strategy = next(iter(json.load(f).values()))
+        self.window_size = strategy["historic_period"]
+        self.stride = strategy.get("stride", 1)
+        self.profit_period = strategy["profit_period"]
+        self.min_profit = strategy["profit"]
+
+    def stages(self, data: Dict[str, pd.DataFrame], tmp_path: str) -> Dict[str, Tuple[Callable, int, int]]:
+        """(function, rows, windows) of each stage. The inputs of a stage are prepared before it is timed."""
+        pre_process = self.pre_process
+        n_rows = sum(df.shape[0] for df in data.values())
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            techs = {ticker: next(iter(pre_process.calculate_strategy(self.strategy_file, df)))[2].dropna()
+                     for ticker, df in data.items()}
+        models = {ticker: self.format(data[ticker], df_tech) for ticker, df_tech in techs.items()}
+        n_windows = sum(df_model.shape[0] for df_model in models.values())
+        tech_rows = sum(df_tech.shape[0] for df_tech in techs.values())
+        n_transposed = sum(len(range(0, df_tech.shape[0] - self.window_size + 1, self.stride)) for df_tech in techs.values())
+
+        dataset_file = os.path.join(tmp_path, "dataset.parquet")
+        with ParquetStreamExport(tmp_path, "dataset") as exporter:
+            for df_model in models.values():
+                exporter.write_table(pre_process.to_arrow_table(df_model.drop(columns=["ticker", "dt_price_start", "dt_price_ends", "profit"])))
+
+        dates = {ticker: df_model["dt_price_ends"].to_numpy() for ticker, df_model in models.items()}
+        scalar_dates = {ticker: values[:max(1, self.max_scalar_calls // len(dates))] for ticker, values in dates.items()}
+        n_scalar = sum(values.shape[0] for values in scalar_dates.values())
+        price_cols = ["open", "close", "high", "low", "volume"]
+
+        def calculate_strategy():
+            with contextlib.redirect_stdout(io.StringIO()):
+                for df in data.values():
+                    list(pre_process.calculate_strategy(self.strategy_file, df))
+
+        def export_parquet():
+            for ticker, df in data.items():
+                ExportToParquet().export(df, os.path.join(tmp_path, "raw"), ticker)
+
+        def stream_parquet():
+            with ParquetStreamExport(tmp_path, "stream") as exporter:
+                for df_model in models.values():
+                    exporter.write_table(pre_process.to_arrow_table(df_model))
+
+        return {
+            "apply_function": (lambda: [pre_process.apply_function(df, "EMA", timeperiod=21) for df in data.values()], n_rows, 0),
+            "calculate_strategy": (calculate_strategy, n_rows, 0),
+            "transpose_columns": (lambda: [pre_process.transpose_columns(df_tech, self.window_size, self.stride,
+                                                                         [col for col in df_tech.columns if col in price_cols])
+                                           for df_tech in techs.values()], tech_rows, n_transposed),
+            "format_dataset": (lambda: [self.format(data[ticker], df_tech) for ticker, df_tech in techs.items()], tech_rows, n_windows),
+            "calculate_proftability": (lambda: [pre_process.calculate_proftability(data[ticker], date, self.profit_period)
+                                                for ticker, values in scalar_dates.items() for date in values], n_scalar, 0),
+            "calculate_proftability_batch": (lambda: [pre_process.calculate_proftability_batch(data[ticker], values, self.profit_period)
+                                                      for ticker, values in dates.items()], n_windows, 0),
+            "linear_regression_slope": (lambda: [pre_process.linear_regression_slope(df["close"], self.window_size, 1)
+                                                 for df in data.values()], n_rows, 0),
+            "read_dataset_from_parquet": (lambda: pre_process.read_dataset_from_parquet(dataset_file), n_windows, n_windows),
+            "read_dataset_from_parquet_arrays": (lambda: pre_process.read_dataset_from_parquet(dataset_file, as_arrays=True),
+                                                 n_windows, n_windows),
+            "ExportToParquet.export": (export_parquet, n_rows, 0),
+            "ParquetStreamExport.write_table": (stream_parquet, n_windows, n_windows),
+        }
+
+    def format(self, df_raw: pd.DataFrame, df_tech: pd.DataFrame) -> pd.DataFrame:
+        return self.pre_process.format_dataset(df_raw, df_tech, self.window_size, self.stride, self.profit_period,
+                                               self.min_profit, list(CATEGORY_COLS), [])
+
+    def run_scale(self, n_tickers: int, n_days: int, only: List[str] = None) -> Dict:
+        data = synthetic_ohlcv(n_tickers, n_days, self.seed)
+        tmp_path = tempfile.mkdtemp(prefix="benchmark_")
+        results = {}
+        try:
+            for stage, (func, rows, windows) in self.stages(data, tmp_path).items():
+                if only and stage not in only:
+                    continue
+                seconds, memory = measure(func, self.repeat)
+                results[stage] = {"seconds": seconds,
+                                  "rows": rows,
+                                  "rows_per_s": rows / seconds if seconds > 0 else None,
+                                  "windows": windows,
+                                  "windows_per_s": windows / seconds if windows and seconds > 0 else None,
+                                  **memory}
+                rss = f"{memory['rss_peak_bytes'] / 2**20:.1f} MiB" if memory["rss_peak_bytes"] is not None else "n/a"
+                print(f"{n_tickers}x{n_days} {stage}: {seconds:.4f}s, {rows} rows, {windows} windows, "
+                      f"peak {memory['peak_bytes'] / 2**20:.1f} MiB, arrow {memory['arrow_allocated_bytes'] / 2**20:.1f} MiB, "
+                      f"rss {rss}")
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return {"tickers": n_tickers, "days": n_days, "stages": results}
+
+    def run(self, scales: List[Tuple[int, int]], only: List[str] = None) -> Dict:
+        return {"environment": environment(),
+                "strategy_file": os.path.basename(self.strategy_file),
+                "repeat": self.repeat,
+                "seed": self.seed,
+                "scales": [self.run_scale(n_tickers, n_days, only) for n_tickers, n_days in scales]}
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {"commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count()}
+
+
+def compare(baseline: Dict, report: Dict) -> List[Dict]:
+    """Speedup (baseline seconds / new seconds) of each stage present in both reports."""
+    old = {(scale["tickers"], scale["days"], stage): values
+           for scale in baseline["scales"] for stage, values in scale["stages"].items()}
+    rows = []
+    for scale in report["scales"]:
+        for stage, values in scale["stages"].items():
+            key = (scale["tickers"], scale["days"], stage)
+            if key in old and values["seconds"] > 0:
+                rows.append({"scale": f"{key[0]}x{key[1]}", "stage": stage,
+                             "baseline_seconds": old[key]["seconds"], "seconds": values["seconds"],
+                             "speedup": old[key]["seconds"] / values["seconds"]})
+
+    return rows
+
+
+def parse_scale(scale: str) -> Tuple[int, int]:
+    n_tickers, n_days = scale.lower().split("x")
+    return int(n_tickers), int(n_days)
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the dataset pipeline with synthetic prices.")
+    parser.add_argument("--scales", nargs="*", default=["5x500", "20x2500"], help="Scales to run, as tickersxdays")
+    parser.add_argument("--strategies", default=DEFAULT_STRATEGY_FILE, help="Strategy configuration file, the first strategy sets the window")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs of each stage, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic prices")
+    parser.add_argument("--only", nargs="*", default=None, help="Stages to run, all by default")
+    parser.add_argument("--output", default=None, help="JSON file where the report is saved")
+    parser.add_argument("--compare", default=None, help="JSON report of a previous run to compare with")
+    options = parser.parse_args(args)
+
+    benchmark = PipelineBenchmark(options.strategies, options.repeat, options.seed)
+    report = benchmark.run([parse_scale(scale) for scale in options.scales], options.only)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if options.compare:
+        with open(options.compare, "r") as f:
+            baseline = json.load(f)
+        for row in compare(baseline, report):
+            print(f"{row['scale']} {row['stage']}: {row['baseline_seconds']:.4f}s -> {row['seconds']:.4f}s "
+                  f"({row['speedup']:.2f}x)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
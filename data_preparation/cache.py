@@ -0,0 +1,294 @@
+"""Cache of the outputs of calculate_strategy, format_dataset and create_train_test_dataset.
+
+Each result is stored under CACHE_PATH/<stage>/<key>/, where the key is a hash of everything the
+stage depends on: the content of the input data, the strategy definition, the func_defs.json
+entries of its functions and the parameters of the stage. Changing one strategy or one
+hyperparameter only invalidates the results that depend on it. The least recently used entries are
+removed when the cache grows beyond max_bytes.
+
+    pre_process = CachedPreProcess(StageCache("/data/cache", max_bytes=20 * 2**30))
+    df_model = pre_process.format_dataset(...)
+    pre_process.from_cache["format_dataset"]  # True if the result was read from the cache
+"""
+import os
+import copy
+import json
+import time
+import shutil
+import hashlib
+import talib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Callable, Dict, List
+from data_preparation.perpare import PreProcess
+from data_preparation.strategy import MultiStrategyPlan, load_func_defs, load_strategies
+from data_preparation.tensors import TENSOR_COLS, dataframe_to_table, table_to_dataframe
+
+# Change it when the format of the stored results (or the output of a stage) changes
+CACHE_VERSION = 1
+META_FILE = "meta.json"
+
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    """Hash of the values, index, column names and dtypes of a DataFrame."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(col), str(dtype)] for col, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+def hash_files(folder_path: str, extension: str = ".parquet") -> str:
+    """Hash of the name, size and modification time of the files of a folder."""
+    files = []
+    for file in sorted(os.listdir(folder_path)):
+        if file.endswith(extension):
+            stat = os.stat(os.path.join(folder_path, file))
+            files.append([file, stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha256(json.dumps(files).encode()).hexdigest()
+
+
+def _folder_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+class StageCache:
+    """Directory of cached results with size-based LRU eviction.
+
+    Entries are written to a temporary folder and renamed when complete, so an interrupted run
+    never leaves a partial entry. Reading an entry marks it as recently used.
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 10 * 2**30) -> None:
+        self.cache_dir = cache_dir or os.environ.get("CACHE_PATH", ".stage_cache")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage: str, *parts) -> str:
+        content = json.dumps([CACHE_VERSION, stage, parts], sort_keys=True, default=str)
+
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, stage, key)
+
+    def get(self, stage: str, key: str) -> str:
+        """Return the folder of the entry, or None if it is not cached."""
+        path = self.path(stage, key)
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # The modification time of the meta file is the last use of the entry
+        os.utime(os.path.join(path, META_FILE))
+        return path
+
+    def meta(self, path: str) -> Dict:
+        with open(os.path.join(path, META_FILE), "r") as f:
+            return json.load(f)
+
+    def put(self, stage: str, key: str, write: Callable[[str], Dict]) -> str:
+        """Create an entry calling write(folder), that saves the result and returns its metadata."""
+        path = self.path(stage, key)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        try:
+            meta = write(tmp_path) or {}
+            meta.update(stage=stage, key=key, created_at=time.time(), bytes=_folder_size(tmp_path))
+            with open(os.path.join(tmp_path, META_FILE), "w") as f:
+                json.dump(meta, f, indent=4)
+
+            if os.path.exists(path):
+                # Another process stored the same result
+                shutil.rmtree(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.evict(keep=path)
+        return path
+
+    def entries(self) -> List[Dict]:
+        """All the complete entries, from the least to the most recently used."""
+        entries = []
+        if not os.path.exists(self.cache_dir):
+            return entries
+
+        for stage in os.listdir(self.cache_dir):
+            stage_path = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_path):
+                continue
+            for key in os.listdir(stage_path):
+                meta_file = os.path.join(stage_path, key, META_FILE)
+                if os.path.exists(meta_file):
+                    with open(meta_file, "r") as f:
+                        size = json.load(f).get("bytes", 0)
+                    entries.append({"path": os.path.join(stage_path, key), "bytes": size,
+                                    "last_used": os.path.getmtime(meta_file)})
+
+        return sorted(entries, key=lambda entry: entry["last_used"])
+
+    def size(self) -> int:
+        return sum(entry["bytes"] for entry in self.entries())
+
+    def evict(self, keep: str = None) -> List[str]:
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(entry["bytes"] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry["path"] == keep:
+                continue
+            shutil.rmtree(entry["path"], ignore_errors=True)
+            total -= entry["bytes"]
+            removed.append(entry["path"])
+
+        return removed
+
+    def clear(self) -> None:
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+
+class CachedPreProcess(PreProcess):
+    """PreProcess that reads calculate_strategy, format_dataset and create_train_test_dataset from a StageCache.
+
+    The outputs are the same as PreProcess. After each call from_cache tells, for each stage, whether
+    the result came from the cache (per strategy for calculate_strategy and create_train_test_dataset).
+    """
+
+    def __init__(self, cache: StageCache = None) -> None:
+        self.cache = cache if cache is not None else StageCache()
+        self.from_cache = {}
+
+    def strategy_key_parts(self, strategy_def: Dict) -> Dict:
+        """Definition of the strategy plus the func_defs.json entries and the talib version it depends on."""
+        func_defs = load_func_defs()
+        functions = [function["function"] for function in strategy_def.get("functions", {}).values()]
+
+        return {"strategy": strategy_def,
+                "func_defs": {func_name: func_defs.get(func_name) for func_name in sorted(set(functions))},
+                "talib": talib.__version__}
+
+    def calculate_strategy(self, strategy_file: str, data_set: pd.DataFrame) -> pd.DataFrame:
+        assert os.path.exists(strategy_file)
+        plans = load_strategies(strategy_file)
+        data_hash = hash_dataframe(data_set)
+        keys = {strategy: self.cache.key("calculate_strategy", data_hash, self.strategy_key_parts(plan.strategy))
+                for strategy, plan in plans.items()}
+        cached = {strategy: self.cache.get("calculate_strategy", key) for strategy, key in keys.items()}
+        self.from_cache["calculate_strategy"] = {strategy: path is not None for strategy, path in cached.items()}
+
+        # Only the strategies that are not cached are calculated, still sharing their common indicators
+        missing = MultiStrategyPlan({strategy: plan for strategy, plan in plans.items() if cached[strategy] is None})
+        results = missing.run(data_set)
+        for strategy, plan in plans.items():
+            if cached[strategy] is not None:
+                df_ret = pd.read_parquet(os.path.join(cached[strategy], "data.parquet"))
+            else:
+                _, _, df_ret = next(results)
+                self.cache.put("calculate_strategy", keys[strategy],
+                               lambda path: df_ret.to_parquet(os.path.join(path, "data.parquet")))
+
+            strategy_def = copy.deepcopy(plan.strategy)
+            print(f"Processing strategy: {strategy_def['description']}")
+
+            yield strategy, strategy_def, df_ret
+
+    def format_dataset(self,
+                       df_raw: pd.DataFrame,
+                       df_tech: pd.DataFrame,
+                       window_size: int,
+                       stride: int,
+                       profit_period: int,
+                       min_profit: float,
+                       cols_to_delete: List,
+                       signal_cols: List,
+                       splited_cols: List = None,
+                       ticker_col: str = "ticker",
+                       date_col: str = "dt_price") -> pd.DataFrame:
+
+        # Only the close price of df_raw is used to calculate the profit
+        key = self.cache.key("format_dataset", hash_dataframe(df_raw[["close"]]), hash_dataframe(df_tech),
+                             window_size, stride, profit_period, min_profit, cols_to_delete, signal_cols,
+                             splited_cols, ticker_col, date_col)
+        path = self.cache.get("format_dataset", key)
+        self.from_cache["format_dataset"] = path is not None
+        if path is not None:
+            # PreProcess.format_dataset adds the ticker and date columns to cols_to_delete
+            if cols_to_delete is not None:
+                cols_to_delete.extend([ticker_col, date_col])
+            df_ret = table_to_dataframe(pq.read_table(os.path.join(path, "data.parquet")))
+            for col, dtype in self.cache.meta(path)["dtypes"].items():
+                df_ret[col] = [values.astype(dtype, copy=False) for values in df_ret[col]]
+            return df_ret
+
+        df_ret = super().format_dataset(df_raw, df_tech, window_size, stride, profit_period, min_profit,
+                                        cols_to_delete, signal_cols, splited_cols, ticker_col, date_col)
+        try:
+            table = dataframe_to_table(df_ret, preserve_index=True)
+        except (ValueError, TypeError, pa.ArrowException):
+            # Windows with non numeric values can not be stored as FixedSizeList, they are not cached
+            return df_ret
+
+        dtypes = {col: str(df_ret[col].iloc[0].dtype) for col, _ in TENSOR_COLS if col in df_ret.columns and df_ret.shape[0] > 0}
+
+        def write(entry_path: str) -> Dict:
+            pq.write_table(table, os.path.join(entry_path, "data.parquet"))
+            return {"dtypes": dtypes}
+
+        self.cache.put("format_dataset", key, write)
+        return df_ret
+
+    def create_train_test_dataset(self, strategy_file: str, test_size: float, random_seed: int, price_cols_to_delete: list = None,
+                                  split_by_date: bool = False, split_date: str = None):
+        self.from_cache["create_train_test_dataset"] = {}
+        super().create_train_test_dataset(strategy_file, test_size, random_seed, price_cols_to_delete, split_by_date, split_date)
+
+    def split_strategy_dataset(self, files_path: str, output_path: str, test_size: float, random_seed: int,
+                               price_cols_to_delete: list = None, split_by_date: bool = False, split_date: str = None) -> None:
+        # The input files are identified by name, size and modification time, reading them would cost as much as the split
+        key = self.cache.key("create_train_test_dataset", hash_files(files_path), test_size, random_seed,
+                             price_cols_to_delete or [], split_by_date, split_date)
+        path = self.cache.get("create_train_test_dataset", key)
+        strategy = os.path.basename(os.path.normpath(files_path))
+        self.from_cache.setdefault("create_train_test_dataset", {})[strategy] = path is not None
+        files = ["train_data.parquet", "test_data.parquet"]
+
+        if path is None:
+            super().split_strategy_dataset(files_path, output_path, test_size, random_seed, price_cols_to_delete,
+                                           split_by_date, split_date)
+
+            def write(entry_path: str) -> Dict:
+                for file in files:
+                    _link_or_copy(os.path.join(output_path, file), os.path.join(entry_path, file))
+
+            self.cache.put("create_train_test_dataset", key, write)
+            return
+
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        for file in files:
+            # Copy with a temporary name, so the previous file is kept if the copy fails
+            tmp_name = os.path.join(output_path, file + ".tmp")
+            shutil.copyfile(os.path.join(path, file), tmp_name)
+            os.replace(tmp_name, os.path.join(output_path, file))
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    """Hard link the file when possible. The dataset files are always replaced, never changed in place."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
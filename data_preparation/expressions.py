@@ -0,0 +1,132 @@
+import re
+import ast
+import threading
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+_COLUMN_REGEX = re.compile(r"\[(.*?)\]")
+_VARIABLE_REGEX = re.compile(r"_col\d+")
+_BIN_OPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide}
+_BIN_SYMBOLS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/"}
+
+
+class CustomColumn:
+    """Expression of a strategy custom column, e.g. "[ema_7] - [ema_21]".
+
+    The expression is parsed once and only column references, numeric constants, parentheses and
+    the operations +, -, * and / are accepted; anything else raises a ValueError when the column
+    is created. The evaluation does not use eval: the expression is evaluated with numexpr, when
+    it is installed, or with NumPy reusing the buffers of the intermediate results. The buffers
+    belong to the thread that evaluates the expression, the compiled columns are shared by all the
+    threads of the process.
+    """
+
+    def __init__(self, name: str, expression: str, use_numexpr: bool = True) -> None:
+        self.name = name
+        self.expression = expression
+        self.columns = []
+
+        def to_variable(match: re.Match) -> str:
+            col = match.group(1)
+            if col not in self.columns:
+                self.columns.append(col)
+            return f"_col{self.columns.index(col)}"
+
+        # Names outside brackets are not columns, they can not be confused with the internal variables
+        if _VARIABLE_REGEX.search(_COLUMN_REGEX.sub("", expression)):
+            raise ValueError(f"Invalid expression [{expression}] in the custom column {name}! The columns must be between brackets")
+
+        try:
+            tree = ast.parse(_COLUMN_REGEX.sub(to_variable, expression).strip(), mode="eval")
+        except SyntaxError as error:
+            raise ValueError(f"Invalid expression [{expression}] in the custom column {name}: {error.msg}") from None
+
+        self._nodes = []
+        self._root = self._compile(tree.body)
+        self._ne_expression = self._to_numexpr(tree.body)
+        self._use_numexpr = use_numexpr and numexpr is not None
+        self._local = threading.local()
+
+    def _compile(self, node: ast.AST) -> int:
+        # Flatten the tree in post order, each node refers to its operands by position
+        if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+            compiled = ("op", _BIN_OPS[type(node.op)], self._compile(node.left), self._compile(node.right))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self._compile(node.operand)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            compiled = ("neg", self._compile(node.operand))
+        elif isinstance(node, ast.Name) and _VARIABLE_REGEX.fullmatch(node.id) and int(node.id[4:]) < len(self.columns):
+            compiled = ("col", int(node.id[4:]))
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            compiled = ("const", node.value)
+        else:
+            raise ValueError(f"Invalid expression [{self.expression}] in the custom column {self.name}! "
+                             "The possible operations are +, -, * and / between columns and numbers")
+
+        self._nodes.append(compiled)
+        return len(self._nodes) - 1
+
+    def _to_numexpr(self, node: ast.AST) -> str:
+        if isinstance(node, ast.BinOp):
+            return f"({self._to_numexpr(node.left)} {_BIN_SYMBOLS[type(node.op)]} {self._to_numexpr(node.right)})"
+        elif isinstance(node, ast.UnaryOp):
+            return f"({'-' if isinstance(node.op, ast.USub) else ''}{self._to_numexpr(node.operand)})"
+        elif isinstance(node, ast.Name):
+            return node.id
+        return repr(node.value)
+
+    def _buffer(self, index: int, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        buffer = buffers.get(index)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            buffers[index] = buffer
+        return buffer
+
+    def evaluate(self, df: pd.DataFrame) -> np.ndarray:
+        return self.evaluate_arrays({col: df[col].to_numpy() for col in self.columns}, df.shape[0])
+
+    def evaluate_arrays(self, data: Dict[str, np.ndarray], length: int) -> np.ndarray:
+        """Same as evaluate, with the columns given as arrays of length elements."""
+        arrays = [data[col] for col in self.columns]
+        shape = (length,)
+        if self._use_numexpr:
+            result = numexpr.evaluate(self._ne_expression, local_dict={f"_col{i}": arr for i, arr in enumerate(arrays)})
+            return np.full(shape, result) if np.ndim(result) == 0 else result
+
+        values = []
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for index, node in enumerate(self._nodes):
+                if node[0] == "col":
+                    values.append(arrays[node[1]])
+                elif node[0] == "const":
+                    values.append(node[1])
+                else:
+                    operands = [values[operand] for operand in node[2:]] if node[0] == "op" else [values[node[1]]]
+                    function = node[1] if node[0] == "op" else np.negative
+                    # The division of integers returns float, like the pandas operators
+                    dtype = np.result_type(*operands, 1.0) if function is np.true_divide else np.result_type(*operands)
+                    # The result of the expression is returned, so it can not be a reused buffer
+                    out = np.empty(shape, dtype=dtype) if index == self._root else self._buffer(index, shape, dtype)
+                    values.append(function(*operands, out=out))
+
+        result = values[self._root]
+        if np.ndim(result) == 0:
+            result = np.full(shape, result)
+        elif any(result is arr for arr in arrays):
+            result = result.copy()
+
+        return result
+
+
+def compile_custom_columns(custom_columns: Dict[str, str], use_numexpr: bool = True) -> List[CustomColumn]:
+    return [CustomColumn(name, expression, use_numexpr) for name, expression in custom_columns.items()]
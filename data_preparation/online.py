@@ -0,0 +1,397 @@
+"""Scores new bars without running the batch path again.
+
+OnlineStrategy keeps, for one ticker and one strategy, the last historic_period rows of the
+indicators and the state of each indicator. The history is processed once by talib (warm_up)
+and each new bar (update) only updates the states and returns the latest window in the layout of
+format_dataset: ticker, dt_price_start, dt_price_ends, shape, series (and price_shape,
+price_cols) and the signal columns. OnlineScorer does the same for all the tickers:
+
+    scorer = OnlineScorer("strategies.json", "EMA_7_21_OBV", cols_to_delete=["market"])
+    scorer.warm_up(df_history)
+    df_model = scorer.update(df_new_bars)            # one row per ticker
+    inputs = scorer.inputs(df_model)
+    model.predict([inputs.series, inputs.signals])
+
+The indicators in INCREMENTAL_FUNCTIONS are updated in O(1) per bar. The other ones (and the
+candles) are recalculated by talib over the last lookback + warmup bars, the same tail used by
+StrategyPlan.run_tail. check_parity compares the output with format_dataset.
+"""
+import collections
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+from talib import abstract
+from typing import Dict, List
+from data_preparation.perpare import PreProcess
+from data_preparation.strategy import IndicatorCall, StrategyPlan, load_strategies
+from data_preparation.tensors import ModelInputs
+from db_access import profiler
+
+
+def _input_names(func_name: str) -> List[str]:
+    """Names of the talib inputs in positional order, e.g. ["high", "low", "close", "volume"] for AD."""
+    names = []
+    for value in abstract.Function(func_name).input_names.values():
+        names.extend(value if isinstance(value, list) else [value])
+
+    return names
+
+
+class IncrementalIndicator(ABC):
+    """State of a talib function that is updated one bar at a time.
+
+    warm_up derives the state from the prices of the history and the outputs calculated by talib
+    and returns False when it can not (e.g. unsupported parameters), in that case the indicator is
+    recalculated on every bar instead.
+    """
+
+    def __init__(self, indicator: IndicatorCall) -> None:
+        self.indicator = indicator
+        info = abstract.Function(indicator.func_name)
+        info.set_parameters({name: val for name, val in indicator.params.items() if name in info.parameters})
+        self.parameters = dict(info.parameters)
+        # The columns of the DataFrame given to each talib input, as listed in func_defs.json
+        self.inputs = dict(zip(_input_names(indicator.func_name), indicator.price_inputs))
+
+    def price(self, bar: Dict[str, float], name: str = "close") -> float:
+        return bar[self.inputs[name]]
+
+    @abstractmethod
+    def warm_up(self, prices: Dict[str, np.ndarray], outputs: Dict[str, np.ndarray]) -> bool:
+        pass
+
+    @abstractmethod
+    def update(self, bar: Dict[str, float]) -> Dict[str, float]:
+        pass
+
+
+class _EMA(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        self.ema = outputs[self.indicator.output_names[0]][-1]
+        self.k = 2.0 / (self.parameters["timeperiod"] + 1)
+        return not np.isnan(self.ema)
+
+    def update(self, bar):
+        # Same operation order as talib
+        self.ema = (self.price(bar) - self.ema) * self.k + self.ema
+        return {self.indicator.output_names[0]: self.ema}
+
+
+class _SMA(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        period = self.parameters["timeperiod"]
+        self.values = collections.deque(prices[self.inputs["close"]][-period:], maxlen=period)
+        return len(self.values) == period
+
+    def update(self, bar):
+        self.values.append(self.price(bar))
+        return {self.indicator.output_names[0]: sum(self.values) / len(self.values)}
+
+
+class _BBANDS(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        period = self.parameters["timeperiod"]
+        self.values = collections.deque(prices[self.inputs["close"]][-period:], maxlen=period)
+        self.middle = outputs[self.indicator.output_names[1]][-1]
+        self.k = 2.0 / (period + 1)
+        # Only the SMA and EMA middle bands are supported. The deviation is always around the simple mean
+        return self.parameters["matype"] in (0, 1) and len(self.values) == period and not np.isnan(self.middle)
+
+    def update(self, bar):
+        self.values.append(self.price(bar))
+        values = np.fromiter(self.values, dtype=float, count=len(self.values))
+        mean = values.mean()
+        if self.parameters["matype"] == 0:
+            self.middle = mean
+        else:
+            self.middle = (values[-1] - self.middle) * self.k + self.middle
+        variance = (values * values).mean() - mean * mean
+        std_dev = np.sqrt(variance) if variance > 0 else 0.0
+        upper, middle, lower = self.indicator.output_names
+
+        return {upper: self.middle + self.parameters["nbdevup"] * std_dev,
+                middle: self.middle,
+                lower: self.middle - self.parameters["nbdevdn"] * std_dev}
+
+
+class _RSI(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        # talib does not return the averages of the gains and losses, they are calculated again with its algorithm
+        period = self.parameters["timeperiod"]
+        values = prices[self.inputs["close"]]
+        if values.shape[0] <= period or np.isnan(values).any():
+            return False
+
+        changes = np.diff(values)
+        self.gain = changes[:period].clip(min=0).sum() / period
+        self.loss = -changes[:period].clip(max=0).sum() / period
+        for change in changes[period:]:
+            self.gain = (self.gain * (period - 1) + max(change, 0.0)) / period
+            self.loss = (self.loss * (period - 1) - min(change, 0.0)) / period
+        self.previous = values[-1]
+
+        return np.isclose(self._rsi(), outputs[self.indicator.output_names[0]][-1], rtol=1e-9, atol=1e-9)
+
+    def _rsi(self) -> float:
+        total = self.gain + self.loss
+        return 100 * self.gain / total if abs(total) >= 1e-8 else 0.0
+
+    def update(self, bar):
+        period = self.parameters["timeperiod"]
+        change = self.price(bar) - self.previous
+        self.previous = self.price(bar)
+        self.gain = (self.gain * (period - 1) + max(change, 0.0)) / period
+        self.loss = (self.loss * (period - 1) - min(change, 0.0)) / period
+
+        return {self.indicator.output_names[0]: self._rsi()}
+
+
+class _ROC(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        period = self.parameters["timeperiod"]
+        self.values = collections.deque(prices[self.inputs["close"]][-period:], maxlen=period)
+        return len(self.values) == period
+
+    def update(self, bar):
+        previous = self.values[0]
+        self.values.append(self.price(bar))
+        if self.indicator.func_name == "MOM":
+            value = self.values[-1] - previous
+        else:
+            value = (self.values[-1] / previous - 1) * 100 if previous != 0 else 0.0
+
+        return {self.indicator.output_names[0]: value}
+
+
+class _OBV(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        self.obv = outputs[self.indicator.output_names[0]][-1]
+        self.previous = prices[self.inputs["close"]][-1]
+        return not np.isnan(self.obv)
+
+    def update(self, bar):
+        price = self.price(bar)
+        if price > self.previous:
+            self.obv += self.price(bar, "volume")
+        elif price < self.previous:
+            self.obv -= self.price(bar, "volume")
+        self.previous = price
+
+        return {self.indicator.output_names[0]: self.obv}
+
+
+class _AD(IncrementalIndicator):
+    def warm_up(self, prices, outputs):
+        self.ad = outputs[self.indicator.output_names[0]][-1]
+        return not np.isnan(self.ad)
+
+    def update(self, bar):
+        high, low, close = self.price(bar, "high"), self.price(bar, "low"), self.price(bar, "close")
+        if high > low:
+            self.ad += ((close - low) - (high - close)) / (high - low) * self.price(bar, "volume")
+
+        return {self.indicator.output_names[0]: self.ad}
+
+
+# Functions with an incremental implementation, the others are recalculated over the last bars
+INCREMENTAL_FUNCTIONS = {"EMA": _EMA, "SMA": _SMA, "BBANDS": _BBANDS, "RSI": _RSI, "ROC": _ROC, "MOM": _ROC,
+                         "OBV": _OBV, "AD": _AD}
+
+
+class OnlineStrategy:
+    """Rolling buffer and indicator state of one strategy for one ticker."""
+
+    def __init__(self, plan: StrategyPlan, cols_to_delete: List = None, signal_cols: List = None, splited_cols: List = None,
+                 ticker_col: str = "ticker", date_col: str = "dt_price", warmup: int = None) -> None:
+        self.plan = plan
+        self.window_size = plan.strategy["historic_period"]
+        self.cols_to_delete = list(cols_to_delete or []) + [ticker_col, date_col]
+        self.signal_cols = list(signal_cols or [])
+        self.splited_cols = list(splited_cols or [])
+        self.ticker_col = ticker_col
+        self.date_col = date_col
+        self.warmup = warmup
+        for indicator in plan.indicators:
+            if indicator.path_dependent and indicator.func_name not in INCREMENTAL_FUNCTIONS:
+                raise ValueError(f"The function {indicator.func_name} depends on the whole history and can not be calculated online.")
+
+    def warm_up(self, history: pd.DataFrame) -> None:
+        """Calculate the indicators of the history (one ticker, ordered by date) with talib and keep the state of the last bar."""
+        plan = self.plan
+        prices = plan.price_arrays(history)
+        outputs = plan.compute(prices)
+        df_tech = plan.apply_custom_columns(plan.merge(history, outputs))
+        if df_tech.shape[0] < self.window_size:
+            raise ValueError(f"The history has {df_tech.shape[0]} rows, at least {self.window_size} are required.")
+
+        self.ticker = history[self.ticker_col].iloc[-1]
+        self.raw_cols = [col for col in history.columns if col != self.date_col]
+        self.cols = [col for col in df_tech.columns
+                     if col not in self.cols_to_delete and col not in self.signal_cols and col not in self.splited_cols]
+        self.row_cols = list(dict.fromkeys(self.cols + self.splited_cols + self.signal_cols))
+
+        # The indicators without incremental state are calculated again over the last tail bars
+        self.states = []
+        self.recalculated = []
+        for indicator in plan.indicators:
+            state = INCREMENTAL_FUNCTIONS[indicator.func_name](indicator) if indicator.func_name in INCREMENTAL_FUNCTIONS else None
+            if state is not None and state.warm_up(prices, outputs):
+                self.states.append(state)
+            else:
+                self.recalculated.append(indicator)
+        lookbacks = [indicator.lookback for indicator in self.recalculated]
+        lookbacks.extend(abstract.Function(candle_func).lookback for candle_func, _ in plan.candles)
+        warmup = self.warmup
+        if warmup is None:
+            # Not only the functions flagged as unstable by talib depend on the past, e.g. MACD uses EMAs
+            warmup = 10 * (max(lookbacks, default=0) + 1) if self.recalculated else 0
+        self.tail_size = max(lookbacks, default=0) + warmup + 1
+        self.prices = {col: values[-self.tail_size:].copy() for col, values in prices.items()}
+
+        # Last window_size rows of the features, the window of the next bar
+        self.dates = df_tech[self.date_col].to_numpy()[-self.window_size:].copy()
+        self.rows = {col: df_tech[col].to_numpy()[-self.window_size:].copy() for col in self.row_cols}
+
+    def _price_tail(self, bar: Dict) -> Dict[str, np.ndarray]:
+        for col, values in self.prices.items():
+            values[:-1] = values[1:]
+            values[-1] = bar[col]
+        return self.prices
+
+    def update(self, bar: Dict) -> Dict:
+        """Add a new bar (a dict or Series with the columns of the history) and return its row of format_dataset.
+
+        The window is made of the window_size bars before the new one and the signals are taken from
+        the new bar, as in format_dataset. The profit and the label are not known yet.
+        """
+        with profiler.stage("online.update", self.ticker):
+            bar = {col: bar[col] for col in self.raw_cols + [self.date_col]}
+            features = {col: bar[col] for col in self.raw_cols}
+            for state in self.states:
+                features.update(state.update(bar))
+
+            prices = self._price_tail(bar)
+            for indicator in self.recalculated:
+                features.update({name: values[-1] for name, values in indicator(prices).items()})
+            for candle_func, function in self.plan.candles:
+                features[candle_func] = function(prices["open"], prices["high"], prices["low"], prices["close"])[-1] / 100
+
+            for custom_column in self.plan.custom_columns:
+                data = {col: np.asarray([features[col]]) for col in custom_column.columns}
+                features[custom_column.name] = custom_column.evaluate_arrays(data, 1)[0]
+
+            row = self._row(bar[self.date_col], features)
+            # The new bar becomes the last row of the next window
+            self.dates[:-1] = self.dates[1:]
+            self.dates[-1] = np.datetime64(bar[self.date_col])
+            for col, values in self.rows.items():
+                values[:-1] = values[1:]
+                values[-1] = features[col]
+
+            return row
+
+    def _row(self, date, features: Dict) -> Dict:
+        series = np.stack([self.rows[col] for col in self.cols], axis=1)
+        row = {self.ticker_col: self.ticker,
+               f"{self.date_col}_start": self.dates[0],
+               f"{self.date_col}_ends": date,
+               "shape": (self.window_size, len(self.cols)),
+               "series": series.reshape(-1)}
+        if self.splited_cols:
+            row["price_shape"] = (self.window_size, len(self.splited_cols))
+            row["price_cols"] = np.stack([self.rows[col] for col in self.splited_cols], axis=1).reshape(-1)
+        row.update({col: features[col] for col in self.signal_cols})
+
+        return row
+
+
+class OnlineScorer:
+    """Online scoring of one strategy for all the tickers, see OnlineStrategy."""
+
+    def __init__(self, strategy_file: str, strategy: str, cols_to_delete: List = None, signal_cols: List = None,
+                 splited_cols: List = None, ticker_col: str = "ticker", date_col: str = "dt_price", warmup: int = None) -> None:
+        plans = load_strategies(strategy_file)
+        if strategy not in plans:
+            raise ValueError(f"The strategy {strategy} is not defined in {strategy_file}.")
+
+        self.plan = plans[strategy]
+        self.options = dict(cols_to_delete=cols_to_delete, signal_cols=signal_cols, splited_cols=splited_cols,
+                            ticker_col=ticker_col, date_col=date_col, warmup=warmup)
+        self.ticker_col = ticker_col
+        self.date_col = date_col
+        self.tickers = {}
+
+    def warm_up(self, history: pd.DataFrame) -> None:
+        """Warm up every ticker of history, a DataFrame with the prices of one or more tickers ordered by date."""
+        for ticker, df_ticker in history.groupby(self.ticker_col, sort=False):
+            online = OnlineStrategy(self.plan, **self.options)
+            online.warm_up(df_ticker.set_index(self.date_col, drop=False) if self.date_col in df_ticker.columns else df_ticker)
+            self.tickers[ticker] = online
+
+    def update(self, bars: pd.DataFrame) -> pd.DataFrame:
+        """Add one new bar per ticker and return their rows of format_dataset, the tickers never warmed up are ignored."""
+        rows = [self.tickers[bar[self.ticker_col]].update(bar)
+                for bar in bars.to_dict("records") if bar[self.ticker_col] in self.tickers]
+
+        return pd.DataFrame(rows)
+
+    def inputs(self, df_model: pd.DataFrame) -> ModelInputs:
+        """Dense arrays of the rows returned by update, as read_tensors returns them (without labels)."""
+        if df_model.shape[0] == 0:
+            return ModelInputs(None, None, np.empty((0, 0)), None, [])
+
+        series = np.stack(df_model["series"].to_numpy()).reshape(-1, *df_model["shape"].iloc[0])
+        price_series = None
+        if "price_cols" in df_model.columns:
+            price_series = np.stack(df_model["price_cols"].to_numpy()).reshape(-1, *df_model["price_shape"].iloc[0])
+        signal_cols = list(self.options["signal_cols"] or [])
+
+        return ModelInputs(series=series,
+                           price_series=price_series,
+                           signals=df_model[signal_cols].to_numpy(dtype=float),
+                           labels=None,
+                           signal_cols=signal_cols)
+
+    def check_parity(self, history: pd.DataFrame, n_bars: int, rtol: float = 1e-6, atol: float = 1e-8) -> Dict:
+        """Compare the online rows of the last n_bars of history with the rows of format_dataset.
+
+        The scorer is warmed up with the rest of the history (its current state is replaced).
+        Only the bars with a label in format_dataset can be compared. Returns the number of rows
+        compared, the maximum absolute difference and whether every value matched.
+        """
+        history = history.sort_values([self.ticker_col, self.date_col])
+        split = history.groupby(self.ticker_col, sort=False).cumcount(ascending=False) < n_bars
+        self.warm_up(history.loc[~split.to_numpy()])
+        online = []
+        new_bars = history.loc[split.to_numpy()]
+        for _, bars in new_bars.groupby(new_bars.groupby(self.ticker_col).cumcount()):
+            online.append(self.update(bars))
+        df_online = pd.concat(online, ignore_index=True)
+
+        pre_process = PreProcess()
+        strategy = self.plan.strategy
+        batch = []
+        for _, df_ticker in history.groupby(self.ticker_col, sort=False):
+            df_raw = df_ticker.set_index(self.date_col, drop=False)
+            df_tech = self.plan.run(df_raw).dropna()
+            batch.append(pre_process.format_dataset(df_raw, df_tech, strategy["historic_period"], 1, strategy["profit_period"],
+                                                    strategy["profit"], list(self.options["cols_to_delete"] or []),
+                                                    list(self.options["signal_cols"] or []), self.options["splited_cols"],
+                                                    self.ticker_col, self.date_col))
+        df_batch = pd.concat(batch, ignore_index=True)
+
+        keys = [self.ticker_col, f"{self.date_col}_ends"]
+        df_online[keys[1]] = pd.to_datetime(df_online[keys[1]])
+        merged = df_online.merge(df_batch, on=keys, suffixes=("_online", "_batch"))
+        max_diff = 0.0
+        matches = merged.shape[0] > 0
+        value_cols = ["series"] + (["price_cols"] if "price_cols" in df_batch.columns else []) + list(self.options["signal_cols"] or [])
+        for col in value_cols:
+            online_values = np.stack(merged[f"{col}_online"].to_numpy()).astype(float) if merged.shape[0] > 0 else np.empty(0)
+            batch_values = np.stack(merged[f"{col}_batch"].to_numpy()).astype(float) if merged.shape[0] > 0 else np.empty(0)
+            if online_values.size > 0:
+                max_diff = max(max_diff, float(np.nanmax(np.abs(online_values - batch_values))))
+                matches &= bool(np.allclose(online_values, batch_values, rtol=rtol, atol=atol, equal_nan=True))
+        matches &= bool((merged[f"{self.date_col}_start_online"].to_numpy() == merged[f"{self.date_col}_start_batch"].to_numpy()).all())
+
+        return {"rows": merged.shape[0], "max_abs_diff": max_diff, "match": matches}
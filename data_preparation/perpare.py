@@ -1,16 +1,24 @@
 import os
-import talib
-import re
 import pandas as pd
 import json
 import enum
 import math
-from sklearn.linear_model import LinearRegression
+import copy
 import numpy as np
-from typing import List
-from talib import abstract
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import List, NamedTuple, Tuple
+from data_preparation.strategy import IndicatorCall, StrategyPlan, MultiStrategyPlan, load_strategies
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.model_selection import train_test_split
-from db_access import ExportToParquet
+from db_access import ParquetStreamExport, ExportToNpyShards, profiler
+from data_preparation.tensors import TENSOR_COLS, column_to_tensor, dataframe_to_table, index_columns, iter_tensors, read_tensors, \
+    tensor_shape
+
+
+def _ticker_of(df: pd.DataFrame, ticker_col: str = "ticker") -> str:
+    """Ticker of a DataFrame with a single ticker, used to label the profiler stages."""
+    return str(df[ticker_col].iloc[0]) if ticker_col in df.columns and df.shape[0] > 0 else None
 
 
 class PROFTABILITY_TYPE(enum.IntEnum):
@@ -18,6 +26,24 @@ class PROFTABILITY_TYPE(enum.IntEnum):
     LOG = 2
 
 
+class WindowSet(NamedTuple):
+    """Windows generated by PreProcess.create_windows, aligned row by row.
+
+    series and price_series are (n_windows, window_size, n_features) arrays, signals is
+    (n_windows, n_signal_cols) and index holds the sequential number of each window, as
+    produced by the original loop before the invalid rows were dropped.
+    """
+    tickers: np.ndarray
+    start_dates: np.ndarray
+    end_dates: np.ndarray
+    series: np.ndarray
+    price_series: np.ndarray
+    signals: np.ndarray
+    profit: np.ndarray
+    label: np.ndarray
+    index: np.ndarray
+
+
 class PivotLevels:
     def __init__(self, high: pd.Series, low: pd.Series, close: pd.Series) -> None:
         self._low = low
@@ -54,89 +80,40 @@ class PivotLevels:
 class PreProcess():
     
     def apply_function(self, data_source: pd.DataFrame, func_name: str, **kwargs)->pd.DataFrame:
-        assert func_name in talib.get_functions(), f"Invalid function {func_name}"
-        price_params = ["open", "close", "high", "low", "volume"]
-        price_params_vals = []
-
-        regex = re.compile(r"\{.*\}")
-
-        # Create a copy of the input dataframe that will be used as the output dataframe
-        df_ret = data_source.copy(deep=True)
-        with open("func_defs.json", "r") as f:
-            func_def = json.load(f)
-            for type in func_def.keys():
-                if func_name in func_def[type]:
-                    input_params = func_def[type][func_name]['input_params']
-                    # Validate the input parameter
-                    for param in input_params:
-                        if param not in price_params and param not in kwargs:
-                            raise ValueError(f"The function {func_name} requires the parameter {param}.")
-                        elif param in price_params:
-                            price_params_vals.append(data_source[param])
-                    
-                    return_values = func_def[type][func_name]['return_values']
-                    # Adjust the name of the output parameters
-                    for i, ret_val in enumerate(return_values):
-                        param_name = regex.search(ret_val)
-                        if param_name is not None:
-                            param_name = param_name.group(0)[1:-1]
-                            return_values[i] = regex.sub(str(kwargs[param_name]), ret_val)
-
-                    # Create areference to the function used to calculate the technical indicator
-                    ta_lib_function = abstract.Function(func_name)
-
-                    if len(return_values) == 1:
-                        df_ret[return_values[0]] = ta_lib_function(*price_params_vals, **kwargs)
-                    else:
-                        ret_aux = []
-                        ret_aux.extend(ta_lib_function(*price_params_vals, **kwargs))
-                        for i, ret in enumerate(ret_aux):
-                            df_ret[return_values[i]] = ret
+        with profiler.ticker(_ticker_of(data_source)), profiler.stage(f"apply_function.{func_name}", rows=data_source.shape[0]):
+            indicator = IndicatorCall(func_name, kwargs)
+            prices = StrategyPlan.price_arrays(data_source)
 
-                    return df_ret
+            return StrategyPlan.merge(data_source, indicator(prices))
 
 
     def calculate_strategy(self, strategy_file: str, data_set: pd.DataFrame)->pd.DataFrame:
         assert os.path.exists(strategy_file)
-        # Read the strategy from the configuration file
-        with open(strategy_file, "r") as f:
-            startegies = json.load(f)
-            for strategy in startegies.keys():
-                df_ret = data_set.copy(deep=True)
-                print(f"Processing strategy: {startegies[strategy]['description']}")
-                for function in startegies[strategy]["functions"]:
-                    dict_aux = startegies[strategy]["functions"]
-                    print(f"Calculating {function}...")
-                    if "params" in dict_aux[function]:
-                        df_ret = self.apply_function(df_ret, dict_aux[function]['function'], **dict_aux[function]['params'])
-                    else:
-                        df_ret = self.apply_function(df_ret, dict_aux[function]['function'])
-
-                if "candles" in startegies[strategy]:
-                    for candle_func in startegies[strategy]["candles"]:
-                         # Create areference to the function used to calculate the technical indicator
-                        ta_lib_function = abstract.Function(candle_func)
-                        df_ret[candle_func] = ta_lib_function(df_ret["open"], df_ret["high"], df_ret["low"], df_ret["close"])/100
+        # Read the strategy from the configuration file, indicators used by more than one strategy are calculated only once
+        multi_plan = MultiStrategyPlan(load_strategies(strategy_file))
+        # The indicators shared by the strategies are calculated with the first one
+        strategies = profiler.iterate(multi_plan.run(data_set), "calculate_strategy", rows=lambda item: item[2].shape[0],
+                                      ticker=_ticker_of(data_set))
+        for strategy, plan, df_ret in strategies:
+            strategy_def = copy.deepcopy(plan.strategy)
+            print(f"Processing strategy: {strategy_def['description']}")
 
-                if "custom_columns" in startegies[strategy]:
-                    reg_exp_cols = re.compile(r"\[(.*?)\]")
-                    reg_exp_ops = re.compile(r"\](.*?)\[")
-                    for key in startegies[strategy]['custom_columns']:
-                        cust_col = startegies[strategy]['custom_columns'][key]
-                        ops = reg_exp_ops.findall(cust_col)
-                        for op in ops:
-                            op = op.strip()
-                            assert op in ['-', '+', '*', '/'], f"Invalid operation[{op}]! The possible operations are +, -, * and /"
+            yield strategy, strategy_def, df_ret
 
-                        columns = reg_exp_cols.findall(cust_col)
 
-                        for col in columns:
-                            cust_col = cust_col.replace(f"[{col}]", f"df_ret['{col}']")     
-                        
-                        df_ret[key] = eval(cust_col)                    
+    def calculate_strategy_tail(self, strategy_file: str, data_set: pd.DataFrame, n_rows: int,
+                                previous: dict = None, warmup: int = None):
+        """Same as calculate_strategy, but only for the last n_rows of data_set (see StrategyPlan.run_tail).
 
+        previous maps the name of each strategy to the DataFrame of its last run, used to align the
+        cumulative indicators.
+        """
+        assert os.path.exists(strategy_file)
+        previous = previous or {}
+        for strategy, plan in load_strategies(strategy_file).items():
+            df_ret = plan.run_tail(data_set, n_rows, previous.get(strategy), warmup)
 
-                yield strategy, startegies[strategy], df_ret
+            yield strategy, copy.deepcopy(plan.strategy), df_ret
 
 
     def transpose_columns(self,
@@ -145,7 +122,8 @@ class PreProcess():
                           shift: int = 1,
                           cols_to_transpose: List[str] = None,
                           dt_column: str = "dt_price",
-                          ticker_column: str = "ticker")->pd.DataFrame:
+                          ticker_column: str = "ticker",
+                          float32: bool = False)->pd.DataFrame:
 
         assert window_size <= df.shape[0], "The window size must be less than the number of rows"
         assert shift > 0, "The parameter shift must be an integer greater than zero"
@@ -155,30 +133,108 @@ class PreProcess():
         if cols_to_transpose is None:
             cols_to_transpose = [col for col in df.columns if col not in [ticker_column, dt_column]]
 
-        col_names = [f"start_{dt_column}", f"end_{dt_column}"]
+        starts = np.arange(0, df.shape[0] - window_size + 1, shift)
+        col_names = [f"{col}_{i}" for col in cols_to_transpose for i in range(window_size)]
+
+        # Columns with the same dtype are transposed together in a single (n_windows, window_size*n_cols) block
+        groups = {}
         for col in cols_to_transpose:
-            # create the list of columns based on the window size
-            col_names.extend([f"{col}_{i}" for i in range(window_size)])
-        
-        i = 0
-        j = window_size
-        values = []
-        while j <= df.shape[0]:
-            row_values = [df[dt_column].iloc[i], df[dt_column].iloc[j-1]]
-            for col in cols_to_transpose:
-                row_values.extend(df[col].iloc[i:j].values)
-            
-            values.append(row_values)
-
-            i += shift
-            j = i+window_size
-        
-        df_ret = pd.DataFrame(data=values, columns=col_names)
+            dtype = np.float32 if float32 and pd.api.types.is_numeric_dtype(df[col]) else df[col].to_numpy().dtype
+            groups.setdefault(np.dtype(dtype), []).append(col)
+
+        blocks = []
+        for dtype, cols in groups.items():
+            values = df[cols].to_numpy(dtype=dtype)
+            # (n_windows, n_cols, window_size) view, the values of each column are consecutive as in the column names
+            view = sliding_window_view(values, window_size, axis=0)[::shift]
+            block = np.empty((starts.shape[0], len(cols) * window_size), dtype=dtype)
+            block.reshape(view.shape)[:] = view
+            blocks.append(pd.DataFrame(block, columns=[f"{col}_{i}" for col in cols for i in range(window_size)], copy=False))
+
+        if len(blocks) == 1:
+            df_ret = blocks[0]
+        else:
+            df_ret = pd.concat(blocks, axis=1)[col_names]
+
+        dates = df[dt_column].to_numpy()
+        df_ret.insert(0, f"end_{dt_column}", dates[starts + window_size - 1])
+        df_ret.insert(0, f"start_{dt_column}", dates[starts])
         df_ret.insert(0, ticker_column, [df[ticker_column].unique()[0]]*df_ret.shape[0])
 
         return df_ret
 
 
+    def create_windows(self,
+                       df_raw: pd.DataFrame,
+                       df_tech: pd.DataFrame,
+                       window_size: int,
+                       stride: int,
+                       profit_period: int,
+                       min_profit: float,
+                       cols: List,
+                       signal_cols: List,
+                       splited_cols: List = None,
+                       ticker_col: str = "ticker",
+                       date_col: str = "dt_price",
+                       drop_invalid: bool = True) -> WindowSet:
+        """Build all the windows of df_tech at once using strided views.
+
+        The window i covers the rows [i*stride, i*stride+window_size) and its signals, end date
+        and profit are taken from the first row after the window. When drop_invalid is True the
+        windows without profit, label or with null signals are removed, like format_dataset does.
+        """
+        assert window_size > 0, "The parameter window size must be greater than 0"
+        assert stride > 0, "The parameter stride must be an integer greater than zero"
+
+        if splited_cols is None:
+            splited_cols = []
+
+        length = df_tech.shape[0]
+        # Each window needs the row that follows it (signals and profit)
+        n_windows = len(range(0, length - window_size, stride))
+        starts = np.arange(n_windows) * stride
+        ends = starts + window_size
+
+        def windows(columns: List)->np.ndarray:
+            values = df_tech[columns].to_numpy()
+            if n_windows == 0:
+                return np.empty((0, window_size, len(columns)), dtype=values.dtype)
+            # sliding_window_view returns (n, n_features, window_size), swap the last axes
+            view = sliding_window_view(values, window_size, axis=0).transpose(0, 2, 1)
+            return view[:ends[-1] - window_size + 1:stride]
+
+        with profiler.stage("format_dataset.windows", rows=n_windows):
+            series = windows(cols)
+            price_series = windows(splited_cols) if splited_cols else None
+            signals = df_tech[signal_cols].to_numpy()[ends]
+            dates = df_tech[date_col].to_numpy()
+            end_dates = dates[ends]
+
+        with profiler.stage("format_dataset.labels", rows=n_windows):
+            profit, label = self.calculate_labels(df_raw, end_dates, [(profit_period, min_profit)], PROFTABILITY_TYPE.LINEAR)
+        profit = profit[:, 0]
+        # A zero profit has no label, the same way "int(profit >= min_profit) if profit else None" behaves
+        label = np.where(profit == 0, np.nan, label[:, 0])
+
+        window_set = WindowSet(tickers=df_tech[ticker_col].to_numpy()[starts],
+                               start_dates=dates[starts],
+                               end_dates=end_dates,
+                               series=series,
+                               price_series=price_series,
+                               signals=signals,
+                               profit=profit,
+                               label=label,
+                               index=np.arange(n_windows))
+
+        if drop_invalid:
+            valid = ~np.isnan(label)
+            if signal_cols:
+                valid &= ~pd.DataFrame(signals).isna().any(axis=1).to_numpy()
+            window_set = WindowSet(*[val[valid] if val is not None else None for val in window_set])
+
+        return window_set
+
+
     def format_dataset(self,
                        df_raw: pd.DataFrame,
                        df_tech: pd.DataFrame,
@@ -192,56 +248,38 @@ class PreProcess():
                        ticker_col: str = "ticker",
                        date_col: str = "dt_price") -> pd.DataFrame:
 
-        if cols_to_delete is not None:
-            cols_to_delete.extend([ticker_col, date_col])
-        else:
-            cols_to_delete = [ticker_col, date_col]
+        with profiler.ticker(_ticker_of(df_tech, ticker_col)), profiler.stage("format_dataset", rows=df_tech.shape[0]):
+            if cols_to_delete is not None:
+                cols_to_delete.extend([ticker_col, date_col])
+            else:
+                cols_to_delete = [ticker_col, date_col]
 
-        if splited_cols is None:
-            splited_cols = []
+            if splited_cols is None:
+                splited_cols = []
 
-        cols = [col for col in df_tech.columns if col not in cols_to_delete and col not in signal_cols and col not in splited_cols]
+            cols = [col for col in df_tech.columns if col not in cols_to_delete and col not in signal_cols and col not in splited_cols]
 
-        i = 0
-        j = i + window_size
-        rows = []
+            window_set = self.create_windows(df_raw, df_tech, window_size, stride, profit_period, min_profit,
+                                             cols, signal_cols, splited_cols, ticker_col, date_col)
+            n_windows = window_set.index.shape[0]
 
-        while j < df_tech.shape[0]:
-            profit = self.calculate_proftability(df_raw, df_tech[date_col].iloc[j], profit_period, PROFTABILITY_TYPE.LINEAR)
+            df_ret = pd.DataFrame(index=window_set.index)
+            df_ret[ticker_col] = window_set.tickers
+            df_ret[f"{date_col}_start"] = window_set.start_dates
+            df_ret[f"{date_col}_ends"] = window_set.end_dates
+            df_ret["shape"] = [(window_size, len(cols))] * n_windows
+            # Flattened copy of each window, stored as one array per row
+            df_ret["series"] = list(window_set.series.reshape(n_windows, window_size * len(cols)))
             if splited_cols:
-                rows.append([df_tech[ticker_col].iloc[i], 
-                            df_tech[date_col].iloc[i], 
-                            df_tech[date_col].iloc[j],
-                            df_tech[cols].iloc[i:j].shape,
-                            df_tech[cols].iloc[i:j].values.flatten(),
-                            df_tech[splited_cols].iloc[i:j].shape,
-                            df_tech[splited_cols].iloc[i:j].values.flatten(),
-                            *df_tech[signal_cols].iloc[j].values,
-                            profit,
-                            int(profit >= min_profit)if profit else None])
-            else:
-                rows.append([df_tech[ticker_col].iloc[i], 
-                            df_tech[date_col].iloc[i], 
-                            df_tech[date_col].iloc[j],
-                            df_tech[cols].iloc[i:j].shape,
-                            df_tech[cols].iloc[i:j].values.flatten(),
-                            *df_tech[signal_cols].iloc[j].values,
-                            profit,
-                            int(profit >= min_profit)if profit else None])
-
-            i += stride
-            j = i + window_size
-
-        if splited_cols:
-            df_col_names = [ticker_col, f"{date_col}_start", f"{date_col}_ends", "shape", "series", "price_shape", "price_cols", *signal_cols, "profit", "label"]
-        else:
-            df_col_names = [ticker_col, f"{date_col}_start", f"{date_col}_ends", "shape", "series", *signal_cols, "profit", "label"]
+                df_ret["price_shape"] = [(window_size, len(splited_cols))] * n_windows
+                df_ret["price_cols"] = list(window_set.price_series.reshape(n_windows, window_size * len(splited_cols)))
 
-        df_ret = pd.DataFrame(rows, columns=df_col_names)
-        df_ret.dropna(inplace=True)
-        df_ret["label"] = df_ret["label"].astype(int)
+            df_signals = pd.DataFrame(window_set.signals, columns=signal_cols, index=window_set.index).infer_objects()
+            df_ret = pd.concat([df_ret, df_signals], axis=1)
+            df_ret["profit"] = window_set.profit
+            df_ret["label"] = window_set.label.astype(int)
 
-        return df_ret
+            return df_ret
 
     def calculate_proftability(self, df: pd.DataFrame, 
                                dt_search: pd.Timestamp, 
@@ -254,89 +292,287 @@ class PreProcess():
         else:
             return None
 
+
+    def calculate_proftability_batch(self, df: pd.DataFrame,
+                                     dt_search: np.ndarray,
+                                     profit_period: int,
+                                     calc_type: PROFTABILITY_TYPE = PROFTABILITY_TYPE.LINEAR)->np.ndarray:
+        """Vectorized version of calculate_proftability for an array of dates.
+
+        The dates without profit_period rows ahead of them get NaN instead of None.
+        """
+        return self._forward_returns(df, dt_search, [profit_period], calc_type)[:, 0]
+
+
+    def calculate_labels(self, df: pd.DataFrame,
+                         dt_search: np.ndarray,
+                         horizons: List[Tuple[int, float]],
+                         calc_type: PROFTABILITY_TYPE = PROFTABILITY_TYPE.LINEAR)->Tuple[np.ndarray, np.ndarray]:
+        """Calculate the profit and the label of each date for several (profit_period, min_profit) pairs.
+
+        Returns two (n_dates, n_horizons) arrays. The label is 1.0 when the profit is greater or equal
+        to min_profit, 0.0 when it is lower and NaN when the profit can not be calculated.
+        """
+        profit = self._forward_returns(df, dt_search, [profit_period for profit_period, _ in horizons], calc_type)
+        min_profits = np.array([min_profit for _, min_profit in horizons], dtype=float)
+        with np.errstate(invalid="ignore"):
+            label = np.where(np.isnan(profit), np.nan, (profit >= min_profits).astype(float))
+
+        return profit, label
+
+
+    def _forward_returns(self, df: pd.DataFrame,
+                         dt_search: np.ndarray,
+                         profit_periods: List[int],
+                         calc_type: PROFTABILITY_TYPE)->np.ndarray:
+        positions = df.index.get_indexer(dt_search)
+        if (positions < 0).any():
+            raise KeyError(f"Dates not found in the index: {np.asarray(dt_search)[positions < 0][:5]}")
+
+        close = df["close"].to_numpy(dtype=float)
+        length = close.shape[0]
+
+        def shifted_close(shift: int)->np.ndarray:
+            # close[k + shift] aligned with k, NaN after the end of the series
+            values = np.full(length, np.nan)
+            if shift < length:
+                values[:length - shift] = close[shift:]
+            return values
+
+        # The position of the purchase is always the day after dt_search
+        entry = shifted_close(1)[positions]
+        profit = np.empty((positions.shape[0], len(profit_periods)))
+        for k, profit_period in enumerate(profit_periods):
+            exit_price = shifted_close(profit_period)[positions]
+            if calc_type == PROFTABILITY_TYPE.LINEAR:
+                profit[:, k] = exit_price/entry - 1
+            else:
+                profit[:, k] = np.log(exit_price/entry)
+
+        return profit
+
     
-    def create_train_test_dataset(self, strategy_file: str, test_size: float, random_seed: int, price_cols_to_delete: list):
+    def create_train_test_dataset(self, strategy_file: str, test_size: float, random_seed: int, price_cols_to_delete: list = None,
+                                  split_by_date: bool = False, split_date: str = None):
+        """Split the datasets of each strategy in train and test files.
+
+        The files are processed one at a time and their rows are written directly as row groups of
+        the train and test parquet files, so only one ticker is kept in memory. The random split is
+        stratified by label and reproducible for a given random_seed. With split_by_date the split is
+        made by dt_price_ends to avoid leakage: the rows from split_date on are the test set or, if no
+        date is given, the last test_size fraction of each ticker.
+        """
         data_file_path = os.environ.get("DATASET_PATH")
         train_ds_base_path = os.environ.get("TRAIN_DATASET")
-        exporter = ExportToParquet()
+        if price_cols_to_delete is None:
+            price_cols_to_delete = []
 
         with open(strategy_file, "r") as f:
-            df_train = None
-            df_test = None
             startegies = json.load(f)
-            for strategy in startegies.keys():
-                files_path = os.path.join(data_file_path, strategy)
-                path_content = os.listdir(files_path)
-                # Filtra os arquivos parquet do diretório
-                path_content = [file for file in path_content if file.endswith(".parquet")]
-                new_dataframe_instance = True
-
-                for file in path_content:
-                    print(f"Processando arquivo {file} na estrategia {strategy}")
+
+        for strategy in startegies.keys():
+            self.split_strategy_dataset(os.path.join(data_file_path, strategy), os.path.join(train_ds_base_path, strategy),
+                                        test_size, random_seed, price_cols_to_delete, split_by_date, split_date)
+
+
+    def split_strategy_dataset(self, files_path: str, output_path: str, test_size: float, random_seed: int,
+                               price_cols_to_delete: list = None, split_by_date: bool = False, split_date: str = None) -> None:
+        """Split the parquet files of files_path (one strategy) in output_path/train_data.parquet and test_data.parquet."""
+        if price_cols_to_delete is None:
+            price_cols_to_delete = []
+
+        strategy = os.path.basename(os.path.normpath(files_path))
+        path_content = os.listdir(files_path)
+        # Filtra os arquivos parquet do diretório
+        path_content = sorted([file for file in path_content if file.endswith(".parquet")])
+
+        with ParquetStreamExport(output_path, "train_data") as train_exporter, \
+             ParquetStreamExport(output_path, "test_data") as test_exporter:
+            for file in path_content:
+                print(f"Processando arquivo {file} na estrategia {strategy}")
+                with profiler.ticker(file.split('.')[0]), profiler.stage("create_train_test_dataset") as span:
                     cols_to_delete = ["ticker", "dt_price_start", "dt_price_ends", "profit"]
-                    df = pd.read_parquet(os.path.join(files_path, file))
+                    # Read as an Arrow table, the windows keep their encoding and are never converted to Python objects
+                    table = pq.read_table(os.path.join(files_path, file))
+                    span.add(rows=table.num_rows)
+                    # The index saved by DataFrame.to_parquet (window numbers of the ticker) is not a feature
+                    cols_to_delete.extend(index_columns(table))
                     # Seleciona as colunas que nao serao usadas no modelo
                     for price_col in price_cols_to_delete:
-                        for df_col in df.columns:
-                            if df_col.startswith(price_col):
-                                cols_to_delete.append(df_col)
-
-                    df.drop(columns=cols_to_delete, inplace=True)
-                    Y = df.pop('label')
-                    remaining_cols_df = df.columns
-
-                    if new_dataframe_instance:
-                        df_test = pd.DataFrame(data=None, columns=remaining_cols_df)
-                        df_train = pd.DataFrame(data=None, columns=remaining_cols_df)
-                        new_dataframe_instance = False
-
-                    # Gera as bases de treino e teste
-                    X_train, X_test, Y_train, Y_test = train_test_split(df.values, 
-                                                                        Y.values, 
-                                                                        test_size=test_size, 
-                                                                        stratify=Y.values, 
-                                                                        random_state=random_seed)
-
-                    for aux_vals, aux_labels, suffix in [(X_train, Y_train, "train"), (X_test, Y_test, "test")]:
-                        df_aux = pd.DataFrame(data=aux_vals, columns=remaining_cols_df)
-                        df_aux["label"] = aux_labels
-                        if suffix == "train":
-                            df_train = pd.concat([df_train, df_aux], ignore_index=True)
+                        for table_col in table.column_names:
+                            if table_col.startswith(price_col):
+                                cols_to_delete.append(table_col)
+
+                    if split_by_date:
+                        dates = table.column("dt_price_ends").to_pandas()
+                        if split_date is not None:
+                            is_test = (dates >= pd.Timestamp(split_date)).to_numpy()
                         else:
-                            df_test = pd.concat([df_test, df_aux], ignore_index=True)
+                            # The last rows of the ticker, ties in dt_price_ends stay together
+                            is_test = (dates >= dates.quantile(1 - test_size, interpolation="higher")).to_numpy()
+                        train_index = np.flatnonzero(~is_test)
+                        test_index = np.flatnonzero(is_test)
+                    else:
+                        # Gera as bases de treino e teste. Splitting the row numbers gives the same rows as splitting the values
+                        train_index, test_index = train_test_split(np.arange(table.num_rows),
+                                                                   test_size=test_size,
+                                                                   stratify=table.column("label").to_numpy(),
+                                                                   random_state=random_seed)
 
-                exporter.export(df_train, os.path.join(train_ds_base_path, strategy), "train_data")
-                exporter.export(df_test, os.path.join(train_ds_base_path, strategy), "test_data")
+                    # The label is the last column, as in the files generated before
+                    columns = [col for col in table.column_names if col not in cols_to_delete and col != "label"]
+                    table = table.select(columns + ["label"])
+                    train_exporter.write_table(table.take(train_index))
+                    test_exporter.write_table(table.take(test_index))
 
 
-    def read_dataset_from_parquet(self, path: str)->np.array:
+    def to_arrow_table(self, df: pd.DataFrame) -> pa.Table:
+        """Convert the output of format_dataset to an Arrow table with the windows stored as FixedSizeList.
+
+        ExportToParquet.export still writes the windows as list<double> with a shape column, both
+        encodings are read by create_train_test_dataset and read_dataset_from_parquet.
+        """
+        return dataframe_to_table(df)
+
+
+    def read_dataset_from_parquet(self, path: str, as_arrays: bool = False):
+        """Read a train/test dataset.
+
+        By default a DataFrame with one (window_size, n_features) array per row in series (and
+        price_cols) is returned. With as_arrays a ModelInputs with the contiguous
+        (N, window_size, n_features) arrays, the signal matrix and the labels is returned instead,
+        built directly from the Arrow buffers.
+        """
         assert os.path.exists(path), f"The file {path} does not exists!"
-        df = pd.read_parquet(path)
-        reshape_cols = [('series', 'shape'), ('price_cols', 'price_shape')]
+        if as_arrays:
+            return read_tensors(path)
+
+        table = pq.read_table(path)
+        df = table.to_pandas()
         cols_to_delete = []
-        for col, shape in reshape_cols:
+        for col, shape in TENSOR_COLS:
             if col in df.columns:
-                val_shape = df[shape][0]
-                df[col] = df[col].transform(lambda val: val.reshape(val_shape))
-                cols_to_delete.append(shape)
-        
+                df[col] = list(column_to_tensor(table.column(col), tensor_shape(table, col, shape)))
+                if shape in df.columns:
+                    cols_to_delete.append(shape)
+
         return df.drop(columns=cols_to_delete)
 
 
+    def export_dataset_shards(self, path: str, folder_path: str, file_name: str, shard_size: int = 65536,
+                              dtype: str = "float32") -> str:
+        """Convert a train/test parquet file to .npy shards (X_ts, X_sig, y and X_price, if present) read by NpyShardDataset.
+
+        The file is read shard_size rows at a time, so it does not need to fit in memory.
+        """
+        assert os.path.exists(path), f"The file {path} does not exists!"
+        exporter = ExportToNpyShards(shard_size, {"X_ts": dtype, "X_sig": dtype, "X_price": dtype})
+        with exporter.writer(folder_path, file_name) as writer:
+            for inputs in iter_tensors(path, shard_size):
+                arrays = {"X_ts": inputs.series, "X_sig": inputs.signals, "y": inputs.labels}
+                if inputs.price_series is not None:
+                    arrays["X_price"] = inputs.price_series
+                writer.add(arrays)
+
+        return writer.path
+
+
     def linear_regression_slope(self, column: pd.Series, window_size: int, stride: int)->np.array:
         assert window_size > 0, "The parameter window size must be greater than 0"
-        length = column.shape[0]
-        array_size = math.ceil(column.shape[0]/stride)
-        slopes = np.full(array_size, np.NaN)
-        slope_index = slopes.shape[0] - 1
-        for index in range(length, 0, -stride):
-            if index >= window_size:
-                X = np.array(range(window_size)).reshape(-1,1)
-                Y = column[index-window_size:index].values
-                model = LinearRegression().fit(X, Y)
-                slopes[slope_index] = model.coef_
-                slope_index -= 1
-            else:
-                break
+        slopes, _, _ = _rolling_ols(column.to_numpy(dtype=float), window_size, stride)
+
+        return slopes
+
+
+    def rolling_regression(self,
+                           df: pd.DataFrame,
+                           columns: List[str],
+                           window_sizes: List[int],
+                           stride: int = 1,
+                           intercept: bool = False,
+                           r2: bool = False)->pd.DataFrame:
+        """Calculate the rolling linear regression of several columns and window sizes at once.
+
+        For each column and window size the output has the column coef_ang_{col}_{window_size}
+        (slope) and, optionally, coef_lin_{col}_{window_size} (intercept) and r2_{col}_{window_size}.
+        The rows are aligned the same way as linear_regression_slope, i.e. with stride 1 the output
+        has the index of df and the first window_size-1 rows are NaN.
+        """
+        assert stride > 0, "The parameter stride must be an integer greater than zero"
+        length = df.shape[0]
+        array_size = math.ceil(length/stride)
+        # Last row of each window, counting backwards from the end of the DataFrame
+        rows = length - 1 - (array_size - 1 - np.arange(array_size)) * stride
+
+        df_ret = pd.DataFrame(index=df.index[rows])
+        for col in columns:
+            values = df[col].to_numpy(dtype=float)
+            for window_size in window_sizes:
+                assert window_size > 0, "The parameter window size must be greater than 0"
+                slopes, intercepts, r2s = _rolling_ols(values, window_size, stride)
+                df_ret[f"coef_ang_{col}_{window_size}"] = slopes
+                if intercept:
+                    df_ret[f"coef_lin_{col}_{window_size}"] = intercepts
+                if r2:
+                    df_ret[f"r2_{col}_{window_size}"] = r2s
+
+        return df_ret
+
 
-        return slopes
\ No newline at end of file
+def _rolling_ols(values: np.ndarray, window_size: int, stride: int)->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Closed-form OLS of each window of values against x = 0..window_size-1.
+
+    Uses cumulative sums of y, x*y and y*y, so the cost does not depend on the window size.
+    Returns slope, intercept and R2 arrays with ceil(len(values)/stride) elements, filled from
+    the end (the last element is the window that ends in the last value) and NaN padded at the
+    beginning. Windows containing NaN have NaN results.
+    """
+    length = values.shape[0]
+    array_size = math.ceil(length/stride)
+    slopes = np.full(array_size, np.nan)
+    intercepts = np.full(array_size, np.nan)
+    r2s = np.full(array_size, np.nan)
+    if length < window_size:
+        return slopes, intercepts, r2s
+
+    # Window ends (exclusive) in ascending order
+    ends = np.arange(length - ((length - window_size) // stride) * stride, length + 1, stride)
+    starts = ends - window_size
+
+    nulls = np.isnan(values)
+    # The slope does not depend on the level of y, centering the series keeps the sums small
+    level = np.nanmean(values) if not nulls.all() else 0.0
+    y = np.where(nulls, 0.0, values - level)
+    t = np.arange(length, dtype=float)
+
+    def window_sum(arr: np.ndarray)->np.ndarray:
+        cum = np.concatenate(([0.0], np.cumsum(arr)))
+        return cum[ends] - cum[starts]
+
+    sum_y = window_sum(y)
+    sum_ty = window_sum(t * y)
+    sum_yy = window_sum(y * y)
+    null_count = window_sum(nulls.astype(float))
+
+    x_mean = (window_size - 1) / 2
+    sxx = window_size * (window_size**2 - 1) / 12
+    y_mean = sum_y / window_size
+    # sum((t - start) * y) over the window
+    sum_xy = sum_ty - starts * sum_y
+    sxy = sum_xy - window_size * x_mean * y_mean
+    syy = sum_yy - window_size * y_mean**2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = sxy / sxx if sxx > 0 else np.zeros_like(sxy)
+        r2 = np.where(syy > 0, slope**2 * sxx / syy, 1.0)
+
+    slope = np.where(null_count > 0, np.nan, slope)
+    # Move the intercept back to the original level of the series
+    intercept = y_mean - slope * x_mean + level
+    r2 = np.where(null_count > 0, np.nan, np.clip(r2, 0.0, 1.0))
+
+    slopes[array_size - ends.shape[0]:] = slope
+    intercepts[array_size - ends.shape[0]:] = intercept
+    r2s[array_size - ends.shape[0]:] = r2
+
+    return slopes, intercepts, r2s
@@ -0,0 +1,268 @@
+"""Runs the dataset pipeline (calculate_strategy -> format_dataset -> export) for many tickers in parallel.
+
+Usage:
+    python -m data_preparation.pipeline --strategies strategies.json --workers 8
+
+The raw price files are read from RAW_DATA_PATH and the datasets are written to
+DATASET_PATH/<strategy>/<ticker>.parquet, the same layout used by the notebooks, with the
+windows encoded as FixedSizeList columns (see PreProcess.to_arrow_table). With --profile the
+stages of every worker are timed and the merged records are saved (see db_access.instrumentation).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import traceback
+import pandas as pd
+from typing import Callable, Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from data_preparation.perpare import PreProcess
+from data_preparation.strategy import MultiStrategyPlan, load_strategies
+from db_access import ParquetStreamExport, profiler
+
+
+class PipelineTask:
+    """Unit of work sent to a worker. Only paths and names are sent, the worker reads the data itself."""
+
+    def __init__(self, raw_file: str, strategy_file: str, strategies: List[str], output_path: str,
+                 signal_cols: List[str] = None, cols_to_delete: List[str] = None, transform: str = None,
+                 date_col: str = "dt_price") -> None:
+        self.raw_file = raw_file
+        self.strategy_file = strategy_file
+        self.strategies = strategies
+        self.output_path = output_path
+        self.signal_cols = signal_cols or []
+        self.cols_to_delete = cols_to_delete or []
+        self.transform = transform
+        self.date_col = date_col
+
+    @property
+    def ticker(self) -> str:
+        return os.path.basename(self.raw_file).split('.')[0]
+
+
+def load_transform(transform: str) -> Callable:
+    """Import a function given as "package.module:function"."""
+    module_name, func_name = transform.split(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def run_task(task: PipelineTask) -> List[Dict]:
+    """Process one ticker and return one result per strategy, failures are returned instead of raised."""
+    pre_process = PreProcess()
+    results = []
+    timings = {}
+
+    try:
+        start = time.perf_counter()
+        df_raw = pd.read_parquet(task.raw_file)
+        df_raw.set_index(task.date_col, drop=False, inplace=True)
+        plans = load_strategies(task.strategy_file)
+        multi_plan = MultiStrategyPlan({strategy: plans[strategy] for strategy in task.strategies})
+        transform = load_transform(task.transform) if task.transform else None
+        timings["read"] = time.perf_counter() - start
+    except Exception:
+        return [_result(task, strategy, "error", timings, error=traceback.format_exc()) for strategy in task.strategies]
+
+    start = time.perf_counter()
+    try:
+        strategies = multi_plan.run(df_raw)
+        for strategy, plan, df_tech in strategies:
+            stage_timings = dict(timings, indicators=time.perf_counter() - start)
+            try:
+                stage_start = time.perf_counter()
+                if transform is not None:
+                    df_tech = transform(df_tech, strategy, plan.strategy)
+                df_tech = df_tech.dropna()
+                stage_timings["transform"] = time.perf_counter() - stage_start
+
+                stage_start = time.perf_counter()
+                df_model = pre_process.format_dataset(df_raw, df_tech,
+                                                      plan.strategy["historic_period"],
+                                                      plan.strategy.get("stride", 1),
+                                                      plan.strategy["profit_period"],
+                                                      plan.strategy["profit"],
+                                                      list(task.cols_to_delete),
+                                                      task.signal_cols)
+                stage_timings["format"] = time.perf_counter() - stage_start
+
+                stage_start = time.perf_counter()
+                with ParquetStreamExport(os.path.join(task.output_path, strategy), task.ticker) as exporter:
+                    exporter.write_table(pre_process.to_arrow_table(df_model))
+                stage_timings["export"] = time.perf_counter() - stage_start
+
+                results.append(_result(task, strategy, "ok", stage_timings, rows=df_raw.shape[0], windows=df_model.shape[0]))
+            except Exception:
+                results.append(_result(task, strategy, "error", stage_timings, error=traceback.format_exc()))
+            start = time.perf_counter()
+    except Exception:
+        # The indicators of the remaining strategies could not be calculated
+        done = [result["strategy"] for result in results]
+        results.extend([_result(task, strategy, "error", timings, error=traceback.format_exc())
+                        for strategy in task.strategies if strategy not in done])
+
+    return results
+
+
+def run_chunk(tasks: List[PipelineTask]) -> List[Dict]:
+    results = []
+    for task in tasks:
+        with profiler.ticker(task.ticker):
+            results.extend(run_task(task))
+    return results
+
+
+def run_worker_chunk(tasks: List[PipelineTask], profile: bool) -> Tuple[List[Dict], List[Dict]]:
+    """run_chunk in a worker process, also returning the profiler records of the chunk.
+
+    The registry of the worker is cleared first, a forked worker starts with a copy of the records of the runner.
+    """
+    if profile:
+        profiler.enable()
+    else:
+        profiler.disable()
+    profiler.reset()
+    results = run_chunk(tasks)
+
+    return results, profiler.records()
+
+
+def _result(task: PipelineTask, strategy: str, status: str, timings: Dict, rows: int = 0, windows: int = 0, error: str = None) -> Dict:
+    return {"ticker": task.ticker,
+            "strategy": strategy,
+            "status": status,
+            "rows": rows,
+            "windows": windows,
+            "timings": timings,
+            "error": error}
+
+
+class PipelineRunner:
+    """Fans the tickers (and, optionally, the strategies) out over a process pool.
+
+    Each worker writes its own output files, so the only data sent back to the runner are the
+    results of each task and, when profile is set (by default, when the profiler is enabled), the
+    profiler records of the worker, that are merged into the profiler of the runner. A failure in
+    one ticker is reported and does not stop the others.
+    """
+
+    def __init__(self, strategy_file: str, output_path: str, workers: int = None, chunksize: int = 1,
+                 split_strategies: bool = False, signal_cols: List[str] = None, cols_to_delete: List[str] = None,
+                 transform: str = None, profile: bool = None) -> None:
+        assert chunksize > 0, "The parameter chunksize must be an integer greater than zero"
+        self.strategy_file = strategy_file
+        self.output_path = output_path
+        self.workers = workers or os.cpu_count()
+        self.chunksize = chunksize
+        self.split_strategies = split_strategies
+        self.signal_cols = signal_cols
+        self.cols_to_delete = cols_to_delete
+        self.transform = transform
+        self.profile = profile
+
+    def create_tasks(self, raw_files: List[str], strategies: List[str] = None) -> List[PipelineTask]:
+        # Fail fast: the strategies (and their custom columns) are validated before any task is created
+        plans = load_strategies(self.strategy_file)
+        strategies = strategies or list(plans.keys())
+        for strategy in strategies:
+            if strategy not in plans:
+                raise ValueError(f"The strategy {strategy} is not defined in {self.strategy_file}.")
+
+        groups = [[strategy] for strategy in strategies] if self.split_strategies else [strategies]
+
+        return [PipelineTask(raw_file, self.strategy_file, group, self.output_path,
+                             self.signal_cols, self.cols_to_delete, self.transform)
+                for raw_file in raw_files for group in groups]
+
+    def run(self, raw_files: List[str], strategies: List[str] = None) -> List[Dict]:
+        tasks = self.create_tasks(raw_files, strategies)
+        chunks = [tasks[i:i + self.chunksize] for i in range(0, len(tasks), self.chunksize)]
+        results = []
+        start = time.perf_counter()
+        print(f"Processing {len(raw_files)} tickers ({len(tasks)} tasks) with {self.workers} workers")
+
+        profile = profiler.enabled if self.profile is None else self.profile
+        if profile:
+            profiler.enable()
+
+        n_done = 0
+        if self.workers == 1:
+            for chunk in chunks:
+                n_done += len(chunk)
+                self._report(run_chunk(chunk), results, n_done, len(tasks), start)
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(run_worker_chunk, chunk, profile): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    try:
+                        chunk_results, records = future.result()
+                        profiler.merge(records)
+                    except Exception:
+                        # The worker died (e.g. out of memory), all the tasks of the chunk failed
+                        chunk_results = [_result(task, strategy, "error", {}, error=traceback.format_exc())
+                                         for task in futures[future] for strategy in task.strategies]
+                    n_done += len(futures[future])
+                    self._report(chunk_results, results, n_done, len(tasks), start)
+
+        failed = [result for result in results if result["status"] != "ok"]
+        print(f"Finished in {time.perf_counter() - start:.1f}s: {len(results) - len(failed)} ok, {len(failed)} failed")
+
+        return results
+
+    def _report(self, chunk_results: List[Dict], results: List[Dict], n_done: int, n_tasks: int, start: float) -> None:
+        results.extend(chunk_results)
+        for result in chunk_results:
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result["timings"].items())
+            print(f"[{n_done}/{n_tasks}] {result['ticker']} {result['strategy']}: {result['status']} "
+                  f"({result['windows']} windows; {stages}) elapsed {time.perf_counter() - start:.1f}s")
+            if result["error"]:
+                print(result["error"], file=sys.stderr)
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Calculate the strategies and format the datasets of all tickers in parallel.")
+    parser.add_argument("--strategies", default="strategies.json", help="Strategy configuration file")
+    parser.add_argument("--raw-path", default=os.environ.get("RAW_DATA_PATH"), help="Folder with the raw price files (RAW_DATA_PATH)")
+    parser.add_argument("--output-path", default=os.environ.get("DATASET_PATH"), help="Output folder (DATASET_PATH)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=1, help="Number of tasks sent to a worker at a time")
+    parser.add_argument("--split-strategies", action="store_true", help="Process each strategy of a ticker in a different task")
+    parser.add_argument("--only", nargs="*", default=None, help="Strategies to process, all by default")
+    parser.add_argument("--tickers", nargs="*", default=None, help="Tickers to process, all by default")
+    parser.add_argument("--signal-cols", nargs="*", default=[], help="Columns used as trading signals")
+    parser.add_argument("--cols-to-delete", nargs="*", default=[], help="Columns removed from the time series")
+    parser.add_argument("--transform", default=None, help="Function applied to the indicators before format_dataset, as module:function")
+    parser.add_argument("--report", default=None, help="JSON file where the result of each task is saved")
+    parser.add_argument("--profile", default=None, help="File (.json or .csv) where the time of each stage, of all the workers, is saved")
+    options = parser.parse_args(args)
+
+    if not options.raw_path or not options.output_path:
+        parser.error("--raw-path and --output-path (or RAW_DATA_PATH and DATASET_PATH) are required")
+
+    # Filtra os arquivos parquet do diretório
+    raw_files = sorted(os.path.join(options.raw_path, file) for file in os.listdir(options.raw_path) if file.endswith(".parquet"))
+    if options.tickers:
+        raw_files = [file for file in raw_files if os.path.basename(file).split('.')[0] in options.tickers]
+
+    runner = PipelineRunner(options.strategies, options.output_path, options.workers, options.chunksize,
+                            options.split_strategies, options.signal_cols, options.cols_to_delete, options.transform,
+                            profile=True if options.profile else None)
+    results = runner.run(raw_files, options.only)
+
+    if options.report:
+        with open(options.report, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if options.profile:
+        if options.profile.endswith(".csv"):
+            profiler.to_csv(options.profile)
+        else:
+            profiler.to_json(options.profile)
+
+    return 0 if all(result["status"] == "ok" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
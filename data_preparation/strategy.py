@@ -0,0 +1,281 @@
+import os
+import re
+import json
+import copy
+import functools
+import talib
+from talib import abstract
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+from data_preparation.expressions import compile_custom_columns
+from db_access.instrumentation import profiler
+
+
+PRICE_PARAMS = ["open", "close", "high", "low", "volume"]
+# Cumulative indicators: the value calculated from a tail of the history differs from the full one by a constant
+ADDITIVE_FUNCTIONS = ["OBV", "AD"]
+# Path-dependent indicators that depend on the whole history, even when the flag is not available in talib
+PATH_DEPENDENT_FUNCTIONS = ["SAR", "SAREXT"]
+FUNC_DEFS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "func_defs.json")
+
+
+@functools.lru_cache(maxsize=None)
+def _read_func_defs(path: str) -> Dict:
+    with open(path, "r") as f:
+        func_def = json.load(f)
+
+    # Index the definitions by function name, the type of the function is kept inside the definition
+    func_defs = {}
+    for type in func_def.keys():
+        for func_name, definition in func_def[type].items():
+            func_defs[func_name] = dict(definition, type=type)
+
+    return func_defs
+
+
+def load_func_defs(path: str = None) -> Dict:
+    """Return the definitions of func_defs.json indexed by function name.
+
+    The file is parsed only once per process. A copy is returned, so the caller can change it
+    without affecting the cached version.
+    """
+    return copy.deepcopy(_read_func_defs(os.path.abspath(path or FUNC_DEFS_PATH)))
+
+
+class IndicatorCall:
+    """A technical indicator resolved ahead of time: talib function, price inputs and output column names."""
+
+    _param_regex = re.compile(r"\{.*\}")
+
+    def __init__(self, func_name: str, params: Dict = None, func_defs: Dict = None) -> None:
+        assert func_name in talib.get_functions(), f"Invalid function {func_name}"
+        if func_defs is None:
+            func_defs = _read_func_defs(FUNC_DEFS_PATH)
+        if func_name not in func_defs:
+            raise ValueError(f"The function {func_name} is not defined in func_defs.json.")
+
+        self.func_name = func_name
+        self.params = dict(params) if params else {}
+        self.price_inputs = []
+
+        definition = func_defs[func_name]
+        # Validate the input parameter
+        for param in definition["input_params"]:
+            if param not in PRICE_PARAMS and param not in self.params:
+                raise ValueError(f"The function {func_name} requires the parameter {param}.")
+            elif param in PRICE_PARAMS:
+                self.price_inputs.append(param)
+
+        # Adjust the name of the output parameters
+        self.output_names = []
+        for ret_val in definition["return_values"]:
+            param_name = self._param_regex.search(ret_val)
+            if param_name is not None:
+                param_name = param_name.group(0)[1:-1]
+                if param_name not in self.params:
+                    raise ValueError(f"The function {func_name} requires the parameter {param_name}.")
+                ret_val = self._param_regex.sub(str(self.params[param_name]), ret_val)
+            self.output_names.append(ret_val)
+
+        # Reference to the function used to calculate the technical indicator
+        self.function = getattr(talib, func_name)
+
+        info = abstract.Function(func_name)
+        flags = info.info["function_flags"] or []
+        self.unstable = "Function has an unstable period" in flags
+        # ADOSC is the difference of two EMAs of AD, the constant of AD cancels out
+        self.additive = func_name in ADDITIVE_FUNCTIONS
+        self.path_dependent = (func_name in PATH_DEPENDENT_FUNCTIONS or "Output is path-dependent" in flags) \
+                              and not self.additive and func_name != "ADOSC"
+        try:
+            info.set_parameters({name: val for name, val in self.params.items() if name in info.parameters})
+            self.lookback = info.lookback
+        except Exception:
+            self.lookback = 0
+
+    @property
+    def key(self) -> tuple:
+        return (self.func_name, tuple(sorted((name, repr(val)) for name, val in self.params.items())))
+
+    def __call__(self, prices: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        with profiler.stage(f"talib.{self.func_name}", rows=len(prices["close"])):
+            values = self.function(*[prices[param] for param in self.price_inputs], **self.params)
+        if len(self.output_names) == 1:
+            values = [values]
+
+        return dict(zip(self.output_names, values))
+
+
+class StrategyPlan:
+    """Technical indicators and candles of a strategy compiled once and applied to any number of tickers.
+
+    Every indicator reads from the same float64 price arrays and all the outputs are added to the
+    DataFrame in a single step, so there is only one copy of the input per run.
+    """
+
+    def __init__(self, strategy: Dict, name: str = None, func_defs: Dict = None) -> None:
+        self.name = name
+        self.strategy = strategy
+        self.indicators = []
+        for function in strategy.get("functions", {}).values():
+            self.indicators.append(IndicatorCall(function["function"], function.get("params"), func_defs))
+
+        self.candles = []
+        for candle_func in strategy.get("candles", []):
+            assert candle_func in talib.get_functions(), f"Invalid function {candle_func}"
+            self.candles.append((candle_func, getattr(talib, candle_func)))
+
+        # Invalid expressions are rejected here, before any ticker is processed
+        self.custom_columns = compile_custom_columns(strategy.get("custom_columns", {}))
+
+    @property
+    def output_names(self) -> List[str]:
+        names = [name for indicator in self.indicators for name in indicator.output_names]
+        names.extend([candle_func for candle_func, _ in self.candles])
+
+        return names
+
+    @staticmethod
+    def price_arrays(data_set: pd.DataFrame) -> Dict[str, np.ndarray]:
+        return {param: data_set[param].to_numpy(dtype=float) for param in PRICE_PARAMS if param in data_set.columns}
+
+    def compute(self, prices: Dict[str, np.ndarray], shared: Dict = None) -> Dict[str, np.ndarray]:
+        """Calculate the outputs of the strategy.
+
+        shared maps IndicatorCall.key (or the candle name) to results already calculated for the
+        same prices; it is used instead of calling talib again and is updated with the new results.
+        """
+        if shared is None:
+            shared = {}
+
+        outputs = {}
+        for indicator in self.indicators:
+            if indicator.key not in shared:
+                shared[indicator.key] = indicator(prices)
+            outputs.update(shared[indicator.key])
+
+        for candle_func, function in self.candles:
+            if candle_func not in shared:
+                with profiler.stage(f"talib.{candle_func}", rows=len(prices["close"])):
+                    shared[candle_func] = function(prices["open"], prices["high"], prices["low"], prices["close"])/100
+            outputs[candle_func] = shared[candle_func]
+
+        return outputs
+
+    @staticmethod
+    def merge(data_set: pd.DataFrame, outputs: Dict[str, np.ndarray]) -> pd.DataFrame:
+        new_cols = [col for col in outputs if col not in data_set.columns]
+        df_ret = pd.concat([data_set, pd.DataFrame({col: outputs[col] for col in new_cols}, index=data_set.index)], axis=1)
+        # Columns that already exist are overwritten in place, as apply_function used to do
+        for col in outputs:
+            if col not in new_cols:
+                df_ret[col] = outputs[col]
+
+        return df_ret
+
+    def apply_custom_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Evaluated in order, a custom column can use the ones defined before it
+        for custom_column in self.custom_columns:
+            with profiler.stage("custom_columns", rows=df.shape[0]):
+                df[custom_column.name] = custom_column.evaluate(df)
+
+        return df
+
+    def run(self, data_set: pd.DataFrame) -> pd.DataFrame:
+        return self.apply_custom_columns(self.merge(data_set, self.compute(self.price_arrays(data_set))))
+
+    @property
+    def lookback(self) -> int:
+        """Number of rows, before the first valid value, required by the indicators of the strategy."""
+        lookbacks = [indicator.lookback for indicator in self.indicators]
+        lookbacks.extend(abstract.Function(candle_func).lookback for candle_func, _ in self.candles)
+
+        return max(lookbacks, default=0)
+
+    def run_tail(self, data_set: pd.DataFrame, n_rows: int, previous: pd.DataFrame = None, warmup: int = None) -> pd.DataFrame:
+        """Calculate the strategy only for the last n_rows of data_set, e.g. after new prices were appended.
+
+        Only the last n_rows + lookback + warmup rows are used. Indicators with an unstable period
+        (EMA, MACD, ...) need a warmup to converge to the values of the full history, by default
+        10 times the lookback. The cumulative indicators (OBV, AD) are aligned with previous, the
+        DataFrame returned by the last run, which must end in the row just before the new ones.
+        Strategies with other path-dependent indicators (e.g. SAR) use the whole history.
+        """
+        assert n_rows > 0, "The parameter n_rows must be an integer greater than zero"
+        length = data_set.shape[0]
+        lookback = self.lookback
+        if warmup is None:
+            warmup = 10 * (lookback + 1) if any(indicator.unstable for indicator in self.indicators) else 0
+
+        additive_cols = [name for indicator in self.indicators if indicator.additive for name in indicator.output_names]
+        # The cumulative indicators are aligned on the row before the new ones, it must be in the tail
+        start = max(0, length - n_rows - lookback - warmup - (1 if additive_cols else 0))
+        if any(indicator.path_dependent for indicator in self.indicators):
+            start = 0
+
+        tail = data_set.iloc[start:]
+        outputs = self.compute(self.price_arrays(tail))
+        if start > 0 and additive_cols:
+            if previous is None or previous.shape[0] == 0:
+                raise ValueError("The previous values of the cumulative indicators are required to calculate the tail.")
+            # Last row calculated by the previous run, it must be in the tail
+            position = tail.index.get_loc(previous.index[-1])
+            for col in additive_cols:
+                outputs[col] = outputs[col] + (previous[col].iloc[-1] - outputs[col][position])
+
+        return self.apply_custom_columns(self.merge(tail, outputs).iloc[-n_rows:].copy())
+
+
+class MultiStrategyPlan:
+    """Evaluates several strategies calculating each distinct (function, params) call only once.
+
+    The union of the calls of all strategies is computed once per ticker and each strategy receives
+    a projection of the shared results with its own output columns.
+    """
+
+    def __init__(self, plans: Dict[str, StrategyPlan]) -> None:
+        self.plans = plans
+
+    @property
+    def n_calls(self) -> int:
+        return sum(len(plan.indicators) + len(plan.candles) for plan in self.plans.values())
+
+    @property
+    def n_unique_calls(self) -> int:
+        keys = set()
+        for plan in self.plans.values():
+            keys.update(indicator.key for indicator in plan.indicators)
+            keys.update(candle_func for candle_func, _ in plan.candles)
+
+        return len(keys)
+
+    def compute(self, prices: Dict[str, np.ndarray]) -> Dict[str, Dict[str, np.ndarray]]:
+        shared = {}
+
+        return {strategy: plan.compute(prices, shared) for strategy, plan in self.plans.items()}
+
+    def run(self, data_set: pd.DataFrame):
+        """Yield (strategy name, plan, DataFrame with the strategy indicators) for each strategy."""
+        outputs = self.compute(StrategyPlan.price_arrays(data_set))
+        for strategy, plan in self.plans.items():
+            yield strategy, plan, plan.apply_custom_columns(plan.merge(data_set, outputs[strategy]))
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_strategies(path: str, mtime: float) -> Dict:
+    with open(path, "r") as f:
+        startegies = json.load(f)
+
+    return {strategy: StrategyPlan(startegies[strategy], strategy) for strategy in startegies.keys()}
+
+
+def load_strategies(strategy_file: str) -> Dict[str, StrategyPlan]:
+    """Return the compiled plan of each strategy in strategy_file.
+
+    The plans are cached until the file is changed.
+    """
+    assert os.path.exists(strategy_file), f"The file {strategy_file} does not exists!"
+    path = os.path.abspath(strategy_file)
+
+    return _compile_strategies(path, os.path.getmtime(path))
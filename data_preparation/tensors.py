@@ -0,0 +1,123 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterator, List, NamedTuple
+
+# Columns with the flattened windows and the columns with their shapes, as generated by format_dataset
+TENSOR_COLS = [("series", "shape"), ("price_cols", "price_shape")]
+SHAPE_METADATA = "tensor_shape.{col}"
+
+
+class ModelInputs(NamedTuple):
+    """Dense arrays read by read_tensors, ready to be used by the model.
+
+    series and price_series are (N, window_size, n_features) arrays (price_series is None when the
+    dataset has no price_cols), signals is (N, len(signal_cols)) and labels is (N,).
+    """
+    series: np.ndarray
+    price_series: np.ndarray
+    signals: np.ndarray
+    labels: np.ndarray
+    signal_cols: List[str]
+
+
+def dataframe_to_table(df: pd.DataFrame, preserve_index: bool = False) -> pa.Table:
+    """Convert a DataFrame generated by format_dataset to an Arrow table.
+
+    The windows are stored as a FixedSizeList column, with their (window_size, n_features) shape in
+    the schema metadata instead of a shape column in every row.
+    """
+    tensor_cols = [(col, shape_col) for col, shape_col in TENSOR_COLS if col in df.columns]
+    shape_cols = [shape_col for _, shape_col in tensor_cols]
+    table = pa.Table.from_pandas(df.drop(columns=[col for col, _ in tensor_cols] + shape_cols), preserve_index=preserve_index)
+    # Keep the order of the columns of the DataFrame
+    columns = [col for col in df.columns if col not in shape_cols]
+    columns.extend([col for col in table.column_names if col.startswith("__index_level_")])
+
+    metadata = {}
+    for col, shape_col in tensor_cols:
+        shape = tuple(df[shape_col].iloc[0]) if df.shape[0] > 0 else (0, 0)
+        values = np.stack(df[col].to_numpy()).astype(float, copy=False) if df.shape[0] > 0 else np.empty((0, int(np.prod(shape))))
+        array = pa.FixedSizeListArray.from_arrays(pa.array(values.reshape(-1)), int(np.prod(shape)))
+        table = table.append_column(col, array)
+        metadata[SHAPE_METADATA.format(col=col).encode()] = json.dumps([int(dim) for dim in shape]).encode()
+
+    table = table.select(columns)
+    metadata.update(table.schema.metadata or {})
+    return table.replace_schema_metadata(metadata)
+
+
+def table_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """Inverse of dataframe_to_table: the windows are returned flattened, with the shape columns, as format_dataset returns them."""
+    df = table.to_pandas()
+    for col, shape_col in TENSOR_COLS:
+        if col in df.columns:
+            shape = tensor_shape(table, col, shape_col)
+            df[col] = list(column_to_tensor(table.column(col), (int(np.prod(shape)),))) if df.shape[0] > 0 else []
+            df.insert(df.columns.get_loc(col), shape_col, [shape] * df.shape[0])
+
+    return df
+
+
+def index_columns(table: pa.Table) -> List[str]:
+    """Columns with the pandas index of a table written from a DataFrame, e.g. __index_level_0__."""
+    pandas_metadata = table.schema.pandas_metadata or {}
+    # A RangeIndex is stored only in the metadata, as a dict
+    columns = [col for col in pandas_metadata.get("index_columns", []) if isinstance(col, str)]
+    columns.extend([col for col in table.column_names if col.startswith("__index_level_") and col not in columns])
+
+    return [col for col in columns if col in table.column_names]
+
+
+def tensor_shape(table: pa.Table, col: str, shape_col: str) -> tuple:
+    metadata = table.schema.metadata or {}
+    key = SHAPE_METADATA.format(col=col).encode()
+    if key in metadata:
+        return tuple(json.loads(metadata[key]))
+
+    # Files written before the FixedSizeList encoding have a shape column
+    return tuple(table.column(shape_col)[0].as_py())
+
+
+def column_to_tensor(column: pa.ChunkedArray, shape: tuple) -> np.ndarray:
+    """Return the list column as a (N, *shape) array, without copies if the column has one chunk."""
+    chunks = [chunk.flatten().to_numpy(zero_copy_only=False) for chunk in column.chunks]
+    values = chunks[0] if len(chunks) == 1 else np.concatenate(chunks) if chunks else np.empty(0)
+
+    return values.reshape((-1, *shape))
+
+
+def table_to_inputs(table: pa.Table, label_col: str = "label") -> ModelInputs:
+    """Convert a train/test table to dense arrays, every column that is not a window, a shape or the label is a signal column."""
+    tensors = {}
+    # The index of the DataFrame is not a feature
+    ignore = [label_col] + index_columns(table)
+    for col, shape_col in TENSOR_COLS:
+        if col in table.column_names:
+            tensors[col] = column_to_tensor(table.column(col), tensor_shape(table, col, shape_col))
+            ignore.extend([col, shape_col])
+
+    signal_cols = [col for col in table.column_names if col not in ignore]
+    signals = np.empty((table.num_rows, len(signal_cols)))
+    for i, col in enumerate(signal_cols):
+        signals[:, i] = table.column(col).to_numpy()
+
+    return ModelInputs(series=tensors.get("series"),
+                       price_series=tensors.get("price_cols"),
+                       signals=signals,
+                       labels=table.column(label_col).to_numpy(),
+                       signal_cols=signal_cols)
+
+
+def read_tensors(path: str, label_col: str = "label") -> ModelInputs:
+    """Read a train/test dataset as dense arrays with no per-row Python work."""
+    return table_to_inputs(pq.read_table(path), label_col)
+
+
+def iter_tensors(path: str, batch_rows: int = 65536, label_col: str = "label") -> Iterator[ModelInputs]:
+    """Same as read_tensors, but reading batch_rows rows at a time."""
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_rows):
+        yield table_to_inputs(pa.Table.from_batches([batch], schema=parquet_file.schema_arrow), label_col)
@@ -1,3 +1,11 @@
 from db_access.export import ExportToParquet as ExportToParquet
 from db_access.export import ExportToPickle as ExportToPickle
+from db_access.export import ParquetStreamExport as ParquetStreamExport
+from db_access.shard_store import ExportToNpyShards as ExportToNpyShards
+from db_access.shard_store import NpyShardDataset as NpyShardDataset
 from db_access.dbo import StockHistory as StockHistory
+from db_access.sql_util import get_engine as get_engine
+from db_access.sql_util import session_scope as session_scope
+from db_access.refresh import RawHistoryRefresher as RawHistoryRefresher
+from db_access.instrumentation import profiler as profiler
+from db_access.instrumentation import Profiler as Profiler
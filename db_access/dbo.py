@@ -1,7 +1,10 @@
-from operator import ge
-from db_access.sql_util import get_session
+import datetime
+from typing import Iterator
+from db_access.sql_util import get_engine, session_scope
+from db_access.instrumentation import profiler
 from sqlalchemy.sql import text
 import pandas as pd
+import numpy as np
 from abc import ABC, abstractmethod
 
 class AbsDbReader(ABC):
@@ -15,12 +18,8 @@ class AbsDbReader(ABC):
 
 
 class StockHistory(AbsDbReader):
-    def __init__(self, str_conn) -> None:
-        super().__init__(str_conn)
-
-    def select(self):
-        session = get_session(self.str_conn)
-        sql_cmd = text("""
+    # Price history of the selected assets, ordered by ticker and date
+    SQL_TEMPLATE = """
                         with tmp_selected_assets as (
                                 select ta.id, ta.ticker, avg(real_volume) ,count(*)
                                 from tb_stock_asset ta
@@ -39,17 +38,86 @@ class StockHistory(AbsDbReader):
                             join tb_issuer ti on ti.id = sa.issuer_id
                             join tb_segment ts on ts.id = ti.segment_id
                             join tb_subsector tss on tss.id = ts.subsector_id
-                            where tp.dt_price > (select max(dt_price) from tb_stock_price) - interval '10 years'
+                            where tp.dt_price > {start_date}
                             order by tsa.ticker, tp.dt_price
-                  """)
-        
-        return pd.read_sql(sql_cmd, session.bind)
+                  """
+    SQL_SELECT = SQL_TEMPLATE.format(start_date="(select max(dt_price) from tb_stock_price) - interval '10 years'")
+    # Only the prices after the date :since
+    SQL_SELECT_DELTA = SQL_TEMPLATE.format(start_date=":since")
+    PRICE_COLS = ["open", "close", "high", "low"]
+    CATEGORY_COLS = ["market", "segment_id", "subsector_id", "economical_sector_id"]
+
+    def __init__(self, str_conn) -> None:
+        super().__init__(str_conn)
+
+    def select(self):
+        sql_cmd = text(self.SQL_SELECT)
+        with profiler.stage("StockHistory.select") as span, session_scope(self.str_conn) as session:
+            df = pd.read_sql(sql_cmd, session.connection())
+            span.add(rows=df.shape[0])
+            return df
+
+    def select_stream(self, chunksize: int = 100000) -> Iterator[pd.DataFrame]:
+        """Yield the price history one ticker at a time.
+
+        The rows are fetched in chunks from a server side cursor, so only one chunk and the
+        ticker being assembled are kept in memory. Prices are returned as float32 and the
+        market and sector columns as categories.
+        """
+        with get_engine(self.str_conn).connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            chunks = pd.read_sql(text(self.SQL_SELECT), connection, chunksize=chunksize)
+            tickers = (self.compact(df) for df in group_by_ticker(chunks))
+            yield from profiler.iterate(tickers, "StockHistory.select_stream", rows=len, ticker=lambda df: df["ticker"].iloc[0])
+
+    def select_delta(self, since: datetime.date) -> pd.DataFrame:
+        """Return only the prices after since, used to refresh the files already exported."""
+        sql_cmd = text(self.SQL_SELECT_DELTA)
+        with profiler.stage("StockHistory.select_delta") as span, session_scope(self.str_conn) as session:
+            df = pd.read_sql(sql_cmd, session.connection(), params={"since": since})
+            span.add(rows=df.shape[0])
+            return df
+
+    @classmethod
+    def compact(cls, df: pd.DataFrame) -> pd.DataFrame:
+        df["dt_price"] = pd.to_datetime(df["dt_price"])
+        for col in cls.PRICE_COLS:
+            if col in df.columns:
+                df[col] = df[col].astype("float32")
+        for col in cls.CATEGORY_COLS:
+            if col in df.columns:
+                df[col] = df[col].astype("category")
+
+        return df.reset_index(drop=True)
 
     def select_markets(self):
-        session = get_session(self.str_conn)
         sql_cmd = text("""
                         select distinct COALESCE(market, 'N/D') as market
                         from tb_issuer
                        """)
+        with session_scope(self.str_conn) as session:
+            return pd.read_sql(sql_cmd, session.connection())
+
+
+def group_by_ticker(chunks: Iterator[pd.DataFrame], ticker_col: str = "ticker") -> Iterator[pd.DataFrame]:
+    """Regroup chunks of rows ordered by ticker into one DataFrame per ticker.
+
+    The rows of the last ticker of a chunk are kept until a chunk with another ticker arrives,
+    since they can continue in the next chunk.
+    """
+    pending = []
+    for chunk in chunks:
+        if chunk.shape[0] == 0:
+            continue
+        tickers = chunk[ticker_col].to_numpy()
+        # Position where each ticker starts inside the chunk
+        starts = [0] + list(np.flatnonzero(tickers[1:] != tickers[:-1]) + 1)
+        for start, end in zip(starts, starts[1:] + [len(tickers)]):
+            part = chunk.iloc[start:end]
+            if pending and pending[0][ticker_col].iloc[0] != part[ticker_col].iloc[0]:
+                yield pd.concat(pending, ignore_index=True)
+                pending = []
+            pending.append(part)
 
-        return pd.read_sql(sql_cmd, session.bind)
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
@@ -2,6 +2,10 @@ import pandas as pd
 import os
 from abc import ABC, abstractmethod
 import pickle
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+from db_access.instrumentation import profiler
 
 
 class AbstractExport(ABC):
@@ -13,20 +17,130 @@ class ExportToParquet(AbstractExport):
     def export(self, df: pd.DataFrame, folder_path: str, file_name: str) -> str:
         assert df.shape[0] > 0, "The DataFrame can not be empty."
 
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
+        # The pipeline workers write the tickers of a strategy to the same folder at the same time
+        os.makedirs(folder_path, exist_ok=True)
 
         if not file_name.endswith(".parquet"):
             file_name = file_name + ".parquet"
 
         full_name = os.path.join(folder_path, file_name)
-        if os.path.exists(full_name):
+        if os.path.isdir(full_name):
+            # File converted to a partitioned dataset by append
+            shutil.rmtree(full_name)
+        elif os.path.exists(full_name):
             os.remove(full_name)
             
-        df.to_parquet(full_name)
+        with profiler.stage("ExportToParquet.export", file_name[:-len(".parquet")], rows=df.shape[0]) as span:
+            df.to_parquet(full_name)
+            span.add(bytes=os.path.getsize(full_name) if profiler.enabled else 0)
 
         return full_name
 
+    def append(self, df: pd.DataFrame, folder_path: str, file_name: str) -> str:
+        """Append the rows of df to an exported file without rewriting it.
+
+        The first append turns <file_name>.parquet into a folder with the same name, where the
+        original file becomes part-00000.parquet and each append adds a new part. pd.read_parquet
+        reads the folder as a single DataFrame, so the readers of the file do not change.
+        The new rows are written with the schema of the existing data.
+        """
+        assert df.shape[0] > 0, "The DataFrame can not be empty."
+
+        if not file_name.endswith(".parquet"):
+            file_name = file_name + ".parquet"
+
+        full_name = os.path.join(folder_path, file_name)
+        if not os.path.exists(full_name):
+            return self.export(df, folder_path, file_name)
+
+        if not os.path.isdir(full_name):
+            tmp_name = full_name + ".tmp"
+            os.rename(full_name, tmp_name)
+            os.makedirs(full_name)
+            os.rename(tmp_name, os.path.join(full_name, "part-00000.parquet"))
+
+        parts = sorted(part for part in os.listdir(full_name) if part.startswith("part-") and part.endswith(".parquet"))
+        schema = pq.read_schema(os.path.join(full_name, parts[0]))
+        df = df.reset_index(drop=True)
+        for name in schema.names:
+            # Columns of the original file that are not in df, e.g. its index
+            if name not in df.columns:
+                df[name] = None
+        table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+        part_name = os.path.join(full_name, f"part-{int(parts[-1][5:10]) + 1:05d}.parquet")
+        with profiler.stage("ExportToParquet.append", file_name[:-len(".parquet")], rows=table.num_rows) as span:
+            pq.write_table(table, part_name)
+            span.add(bytes=os.path.getsize(part_name) if profiler.enabled else 0)
+
+        return part_name
+
+class ParquetStreamExport:
+    """Writes a parquet file incrementally, each call to write adds a row group.
+
+    The schema is defined by the first DataFrame, the next ones are converted to it. The file is
+    written with a temporary name and only replaces the existing one when the export is closed
+    without errors. Use it as a context manager:
+
+        with ParquetStreamExport(folder_path, "train_data") as exporter:
+            exporter.write(df)
+    """
+
+    def __init__(self, folder_path: str, file_name: str) -> None:
+        if not file_name.endswith(".parquet"):
+            file_name = file_name + ".parquet"
+
+        self.full_name = os.path.join(folder_path, file_name)
+        self._tmp_name = self.full_name + ".tmp"
+        self._writer = None
+        self.rows = 0
+
+        os.makedirs(folder_path, exist_ok=True)
+
+    def write(self, df: pd.DataFrame) -> None:
+        self.write_table(pa.Table.from_pandas(df, preserve_index=False))
+
+    def write_table(self, table: pa.Table) -> None:
+        if table.num_rows == 0:
+            return
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._tmp_name, table.schema)
+        elif not table.schema.equals(self._writer.schema, check_metadata=False):
+            table = table.select(self._writer.schema.names).cast(self._writer.schema)
+
+        with profiler.stage("ParquetStreamExport.write_table", rows=table.num_rows):
+            self._writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self) -> str:
+        assert self._writer is not None, "The DataFrame can not be empty."
+        with profiler.stage("ParquetStreamExport.close", rows=self.rows) as span:
+            self._writer.close()
+            span.add(bytes=os.path.getsize(self._tmp_name) if profiler.enabled else 0)
+
+        if os.path.isdir(self.full_name):
+            shutil.rmtree(self.full_name)
+        os.replace(self._tmp_name, self.full_name)
+
+        return self.full_name
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            os.remove(self._tmp_name)
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 class ExportToPickle(AbstractExport):
     def export(self, model: object, folder_path: str, file_name: str)->str:
         if not os.path.exists(folder_path):
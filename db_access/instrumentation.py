@@ -0,0 +1,217 @@
+"""Opt-in timers and counters for the stages of the dataset pipeline.
+
+The stages record their wall time, rows and bytes written in the process-wide registry profiler,
+per stage and per ticker. Nothing is recorded until it is enabled (or PIPELINE_PROFILE=1 is set),
+and a disabled stage costs one attribute check:
+
+    from db_access import profiler
+
+    profiler.enable()
+    for strategy, strategy_def, df_tech in pre_process.calculate_strategy(strategy_file, df_raw):
+        ...
+    profiler.to_csv("profile.csv")
+
+Each process has its own registry. PipelineRunner returns the records of its workers with their
+results and adds them to the registry of the runner with Profiler.merge, so the report of the
+runner covers every worker. From the command line:
+
+    python -m data_preparation.pipeline --workers 8 --profile profile.json
+"""
+import os
+import csv
+import json
+import time
+import functools
+import threading
+import contextvars
+from typing import Callable, Dict, Iterable, Iterator, List
+
+# Ticker of the stages that do not give one, set with profiler.ticker(...)
+_current_ticker = contextvars.ContextVar("current_ticker", default=None)
+
+FIELDS = ["stage", "ticker", "calls", "seconds", "rows", "bytes"]
+
+
+class _NullSpan:
+    """Span returned while the profiler is disabled, it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+    def add(self, rows: int = 0, bytes: int = 0) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Times one call of a stage, the rows and bytes can be added while it runs."""
+
+    def __init__(self, profiler: "Profiler", stage: str, ticker: str, rows: int, bytes: int) -> None:
+        self.profiler = profiler
+        self.stage = stage
+        self.ticker = ticker
+        self.rows = rows
+        self.bytes = bytes
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.profiler.record(self.stage, time.perf_counter() - self._start, self.rows, self.bytes, self.ticker)
+
+    def add(self, rows: int = 0, bytes: int = 0) -> None:
+        self.rows += rows
+        self.bytes += bytes
+
+
+class _TickerScope:
+    """Sets the current ticker while it is open."""
+
+    def __init__(self, ticker: str) -> None:
+        self.ticker = ticker
+
+    def __enter__(self):
+        self._token = _current_ticker.set(self.ticker)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        _current_ticker.reset(self._token)
+
+
+class Profiler:
+    """Registry of the calls, time, rows and bytes of each (stage, ticker)."""
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._records = {}
+
+    def stage(self, stage: str, ticker: str = None, rows: int = 0, bytes: int = 0):
+        """Context manager that records one call of stage, e.g.:
+
+            with profiler.stage("format_dataset", rows=df.shape[0]) as span:
+                ...
+                span.add(bytes=size)
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+
+        return _Span(self, stage, ticker, rows, bytes)
+
+    def record(self, stage: str, seconds: float = 0.0, rows: int = 0, bytes: int = 0, ticker: str = None) -> None:
+        """Add a call of stage, with ticker defaulting to the one set by profiler.ticker."""
+        if not self.enabled:
+            return
+
+        key = (stage, ticker if ticker is not None else _current_ticker.get())
+        with self._lock:
+            values = self._records.setdefault(key, [0, 0.0, 0, 0])
+            values[0] += 1
+            values[1] += seconds
+            values[2] += int(rows)
+            values[3] += int(bytes)
+
+    def timed(self, stage: str = None) -> Callable:
+        """Decorator that records every call of the function, named stage or the qualified name of the function."""
+        def decorator(func: Callable) -> Callable:
+            name = stage or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Span(self, name, None, 0, 0):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def iterate(self, iterable: Iterable, stage: str, rows: Callable = None, ticker=None) -> Iterator:
+        """Yield the items of iterable recording the time spent producing each one.
+
+        rows is an optional function of the item, e.g. len. ticker is either a function of the item
+        or a ticker name, that is also the current ticker while each item is produced (generators
+        can not keep profiler.ticker open across their yields). The time of the consumer between
+        the items is not counted.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                if isinstance(ticker, str) and self.enabled:
+                    with _TickerScope(ticker):
+                        item = next(iterator)
+                else:
+                    item = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.record(stage, time.perf_counter() - start, rows(item) if rows else 0, 0,
+                            ticker(item) if callable(ticker) else ticker)
+            yield item
+
+    def ticker(self, ticker: str):
+        """Context manager that sets the ticker of the stages recorded inside it."""
+        if not self.enabled:
+            return _NULL_SPAN
+
+        return _TickerScope(ticker)
+
+    def records(self) -> List[Dict]:
+        """One dict per (stage, ticker), the stages recorded without a ticker have ticker None."""
+        with self._lock:
+            items = list(self._records.items())
+
+        return [dict(zip(FIELDS, [stage, ticker] + values)) for (stage, ticker), values in items]
+
+    def summary(self) -> List[Dict]:
+        """The records added up by stage, sorted by the total time."""
+        stages = {}
+        for record in self.records():
+            values = stages.setdefault(record["stage"], dict(record, ticker=None, calls=0, seconds=0.0, rows=0, bytes=0))
+            for field in ["calls", "seconds", "rows", "bytes"]:
+                values[field] += record[field]
+
+        return sorted(stages.values(), key=lambda values: values["seconds"], reverse=True)
+
+    def merge(self, records: List[Dict]) -> None:
+        """Add the records of another registry, e.g. returned by a worker process."""
+        with self._lock:
+            for record in records:
+                values = self._records.setdefault((record["stage"], record["ticker"]), [0, 0.0, 0, 0])
+                for i, field in enumerate(["calls", "seconds", "rows", "bytes"]):
+                    values[i] += record[field]
+
+    def to_json(self, path: str) -> str:
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "records": self.records()}, f, indent=4)
+
+        return path
+
+    def to_csv(self, path: str) -> str:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records())
+
+        return path
+
+
+profiler = Profiler(enabled=os.environ.get("PIPELINE_PROFILE", "0").lower() in ["1", "true", "yes"])
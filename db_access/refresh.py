@@ -0,0 +1,83 @@
+import os
+import json
+import datetime
+import pandas as pd
+from typing import Dict
+from db_access.dbo import StockHistory
+from db_access.export import ExportToParquet
+
+
+class RawHistoryRefresher:
+    """Keeps the raw price files (one parquet per ticker) up to date without reloading the whole history.
+
+    The last dt_price of each ticker is recorded in a manifest saved in the same folder. A refresh
+    queries only the rows after the oldest date of the manifest and appends the new rows of each
+    ticker to its file with ExportToParquet.append.
+    """
+
+    def __init__(self, str_conn: str, raw_path: str, manifest_name: str = "_manifest.json", reader: StockHistory = None) -> None:
+        self.raw_path = raw_path
+        self.manifest_path = os.path.join(raw_path, manifest_name)
+        self.reader = reader if reader is not None else StockHistory(str_conn)
+        self.exporter = ExportToParquet()
+
+    def load_manifest(self) -> Dict[str, pd.Timestamp]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+
+        return {ticker: pd.Timestamp(dt_price) for ticker, dt_price in manifest["tickers"].items()}
+
+    def save_manifest(self, manifest: Dict[str, pd.Timestamp]) -> None:
+        if not os.path.exists(self.raw_path):
+            os.makedirs(self.raw_path)
+
+        content = {"updated_at": datetime.datetime.now().isoformat(),
+                   "tickers": {ticker: dt_price.isoformat() for ticker, dt_price in sorted(manifest.items())}}
+        # Write to a temporary file first, so an interrupted refresh does not corrupt the manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def refresh(self, full: bool = False) -> Dict[str, int]:
+        """Update the raw files and return the number of new rows of each ticker.
+
+        A full refresh (or the first one, when there is no manifest) exports the whole history again.
+        Tickers that are not in the manifest are ignored by the incremental refresh, since only their
+        last rows would be available, and are reported so a full refresh can be scheduled.
+        """
+        manifest = self.load_manifest()
+        new_rows = {}
+
+        if full or not manifest:
+            manifest = {}
+            for df in self.reader.select_stream():
+                ticker = df["ticker"].iloc[0]
+                self.exporter.export(df, self.raw_path, ticker)
+                manifest[ticker] = df["dt_price"].max()
+                new_rows[ticker] = df.shape[0]
+            self.save_manifest(manifest)
+            return new_rows
+
+        df = self.reader.select_delta(min(manifest.values()).to_pydatetime())
+        df["dt_price"] = pd.to_datetime(df["dt_price"])
+        new_tickers = []
+        for ticker, df_ticker in df.groupby("ticker", sort=False):
+            if ticker not in manifest:
+                new_tickers.append(ticker)
+                continue
+
+            df_ticker = df_ticker.loc[df_ticker["dt_price"] > manifest[ticker]]
+            if df_ticker.shape[0] > 0:
+                self.exporter.append(df_ticker, self.raw_path, ticker)
+                manifest[ticker] = df_ticker["dt_price"].max()
+                new_rows[ticker] = df_ticker.shape[0]
+
+        self.save_manifest(manifest)
+        if new_tickers:
+            print(f"New tickers found, run a full refresh to load their history: {', '.join(new_tickers)}")
+
+        return new_rows
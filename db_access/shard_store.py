@@ -0,0 +1,197 @@
+import os
+import json
+import queue
+import shutil
+import threading
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+from db_access.export import AbstractExport
+
+INDEX_FILE = "index.json"
+
+
+class NpyShardWriter:
+    """Appends rows of several aligned arrays (e.g. X_ts, X_sig and y) to fixed-dtype .npy shards.
+
+    Rows are buffered until shard_size rows are available, so at most one shard is kept in
+    memory. The JSON index with the dtype and shape of each array and the size of each shard is
+    written by close. Use it as a context manager.
+    """
+
+    def __init__(self, path: str, dtypes: Dict[str, str] = None, shard_size: int = 65536) -> None:
+        assert shard_size > 0, "The parameter shard_size must be an integer greater than zero"
+        self.path = path
+        self.dtypes = dtypes or {}
+        self.shard_size = shard_size
+        self.arrays = {}
+        self.shards = []
+        self._buffer = {}
+        self._buffer_rows = 0
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    def add(self, arrays: Dict[str, np.ndarray]) -> None:
+        rows = {name: values.shape[0] for name, values in arrays.items()}
+        assert len(set(rows.values())) == 1, f"All the arrays must have the same number of rows: {rows}"
+        if not self.arrays:
+            self.arrays = {name: {"dtype": np.dtype(self.dtypes.get(name, values.dtype)).str, "shape": list(values.shape[1:])}
+                           for name, values in arrays.items()}
+        assert set(arrays.keys()) == set(self.arrays.keys()), f"The arrays must be {list(self.arrays.keys())}"
+
+        for name, values in arrays.items():
+            self._buffer.setdefault(name, []).append(np.asarray(values, dtype=self.arrays[name]["dtype"]))
+        self._buffer_rows += next(iter(rows.values()))
+
+        while self._buffer_rows >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def _flush(self, n_rows: int) -> None:
+        number = len(self.shards)
+        files = {}
+        for name in self.arrays:
+            values = np.concatenate(self._buffer[name]) if len(self._buffer[name]) > 1 else self._buffer[name][0]
+            files[name] = f"{name}-{number:05d}.npy"
+            np.save(os.path.join(self.path, files[name]), values[:n_rows])
+            self._buffer[name] = [values[n_rows:]]
+
+        self.shards.append({"rows": n_rows, "files": files})
+        self._buffer_rows -= n_rows
+
+    def close(self) -> str:
+        if self._buffer_rows > 0:
+            self._flush(self._buffer_rows)
+
+        index = {"rows": sum(shard["rows"] for shard in self.shards),
+                 "arrays": self.arrays,
+                 "shards": self.shards}
+        with open(os.path.join(self.path, INDEX_FILE), "w") as f:
+            json.dump(index, f, indent=4)
+
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+
+
+class ExportToNpyShards(AbstractExport):
+    """Exports a dict of aligned arrays as a folder of .npy shards that can be read by NpyShardDataset."""
+
+    def __init__(self, shard_size: int = 65536, dtypes: Dict[str, str] = None) -> None:
+        self.shard_size = shard_size
+        self.dtypes = dtypes
+
+    def export(self, arrays: Dict[str, np.ndarray], folder_path: str, file_name: str) -> str:
+        with self.writer(folder_path, file_name) as writer:
+            writer.add(arrays)
+
+        return writer.path
+
+    def writer(self, folder_path: str, file_name: str) -> NpyShardWriter:
+        return NpyShardWriter(os.path.join(folder_path, file_name), self.dtypes, self.shard_size)
+
+
+class NpyShardDataset:
+    """Reads a dataset written by ExportToNpyShards with memory-mapped shards.
+
+    Only the rows of the current batches are loaded, so datasets larger than the memory can be used
+    for training, e.g.:
+
+        dataset = NpyShardDataset(path)
+        full_model.fit(dataset.batches(64, epochs=None), steps_per_epoch=dataset.steps(64), epochs=200)
+    """
+
+    def __init__(self, path: str) -> None:
+        assert os.path.exists(os.path.join(path, INDEX_FILE)), f"The file {os.path.join(path, INDEX_FILE)} does not exists!"
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), "r") as f:
+            self.index = json.load(f)
+
+        self.shards = [{name: np.load(os.path.join(path, file), mmap_mode="r") for name, file in shard["files"].items()}
+                       for shard in self.index["shards"]]
+        # Position of the first row of each shard
+        self._offsets = np.cumsum([0] + [shard["rows"] for shard in self.index["shards"]])
+
+    def __len__(self) -> int:
+        return self.index["rows"]
+
+    def steps(self, batch_size: int) -> int:
+        return int(np.ceil(len(self) / batch_size))
+
+    def take(self, rows: np.ndarray, names: List[str]) -> Dict[str, np.ndarray]:
+        """Load the given rows, reading each shard once and its rows in ascending order."""
+        rows = np.sort(rows)
+        shard_numbers = np.searchsorted(self._offsets, rows, side="right") - 1
+        parts = {name: [] for name in names}
+        for shard_number in np.unique(shard_numbers):
+            shard_rows = rows[shard_numbers == shard_number] - self._offsets[shard_number]
+            for name in names:
+                parts[name].append(self.shards[shard_number][name][shard_rows])
+
+        return {name: np.concatenate(values) for name, values in parts.items()}
+
+    def _iter_batches(self, batch_size: int, shuffle: bool, seed: int, epochs: int, inputs: List[str], target: str) -> Iterator[Tuple]:
+        rng = np.random.default_rng(seed)
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            order = rng.permutation(len(self)) if shuffle else np.arange(len(self))
+            for start in range(0, len(self), batch_size):
+                rows = order[start:start + batch_size]
+                values = self.take(rows, inputs + [target])
+                yield [values[name] for name in inputs], values[target]
+            epoch += 1
+
+    def batches(self, batch_size: int, shuffle: bool = True, seed: int = None, epochs: int = 1, prefetch: int = 2,
+                inputs: List[str] = None, target: str = "y") -> Iterator[Tuple]:
+        """Yield ([X_ts, X_sig], y) mini-batches, or the arrays given in inputs.
+
+        The batches are loaded by a background thread that keeps up to prefetch batches ready.
+        epochs=None loops forever, as expected by keras when steps_per_epoch is given.
+        """
+        if inputs is None:
+            inputs = ["X_ts", "X_sig"]
+        generator = self._iter_batches(batch_size, shuffle, seed, epochs, inputs, target)
+        if prefetch <= 0:
+            yield from generator
+            return
+
+        batches = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item) -> bool:
+            # Give up when the consumer is gone, otherwise the thread would wait forever on a full queue
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer() -> None:
+            try:
+                for batch in generator:
+                    if not put(batch):
+                        return
+                put(end)
+            except Exception as error:
+                put(error)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
@@ -1,11 +1,84 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
+# Engines (and their connection pools) shared by the whole process, keyed by connection string and options.
+# The session makers are keyed by engine
+_engines = {}
+_session_makers = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def _reset_after_fork() -> None:
+    """Drop the engines inherited from the parent process without closing its connections."""
+    global _pid, _lock
+    for engine in _engines.values():
+        try:
+            engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33 has no close parameter, just forget the pool
+            pass
+    _engines.clear()
+    _session_makers.clear()
+    _lock = threading.Lock()
+    _pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_engine(conn_string: str,
+               echo: bool = False,
+               pool_size: int = 5,
+               max_overflow: int = 10,
+               pool_pre_ping: bool = True) -> Engine:
+
+    """Return the engine of the connection string, creating it only in the first call.
+
+    The engines are created once per process: a forked worker creates its own engine and never
+    uses the pooled connections of the parent.
+
+    Args:
+        conn_string (str): Connection String
+        echo (bool, optional): Indicates whether the engine will log the SQL commands os not. Defaults to False.
+        pool_size (int, optional): Number of connections kept in the pool. Defaults to 5.
+        max_overflow (int, optional): Connections that can be opened above pool_size. Defaults to 10.
+        pool_pre_ping (bool, optional): Test the connections before using them. Defaults to True.
+
+    Returns:
+        Engine: SQLAlchemy Engine connected to the database.
+    """
+
+    if os.getpid() != _pid:
+        _reset_after_fork()
+
+    key = (conn_string, echo, pool_size, max_overflow, pool_pre_ping)
+    with _lock:
+        if key not in _engines:
+            options = {"echo": echo, "pool_pre_ping": pool_pre_ping}
+            # SQLite does not use a QueuePool in every configuration, keep its defaults
+            if make_url(conn_string).get_backend_name() != "sqlite":
+                options.update(pool_size=pool_size, max_overflow=max_overflow)
+            _engines[key] = create_engine(conn_string, **options)
+            _session_makers[_engines[key]] = sessionmaker(bind=_engines[key])
+
+        return _engines[key]
+
+
 def get_session(conn_string:str, echo:bool = False)->Session:
 
     """Return a valid session instance.
 
+    The session uses the engine shared by the process (see get_engine), the caller is responsible
+    for closing it. Prefer session_scope, that closes the session automatically.
+
     Args:
         conn_string (str): Connection String
         echo (bool, optional): Indicates whether the Session will log the SQL commands os not. Defaults to False.
@@ -14,10 +87,33 @@ def get_session(conn_string:str, echo:bool = False)->Session:
         Session: SQLAlchemy Session connected to the database.
     """
 
-    engine = create_engine(conn_string, echo=echo)
-    Session = sessionmaker(bind=engine)
+    engine = get_engine(conn_string, echo=echo)
+
+    return _session_makers[engine]()
+
+
+@contextmanager
+def session_scope(conn_string: str, echo: bool = False) -> Iterator[Session]:
+
+    """Context manager that commits the session on success, rolls it back on error and always closes it.
+
+    Args:
+        conn_string (str): Connection String
+        echo (bool, optional): Indicates whether the Session will log the SQL commands os not. Defaults to False.
+
+    Yields:
+        Session: SQLAlchemy Session connected to the database.
+    """
 
-    return Session()
+    session = get_session(conn_string, echo)
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
 # Base class that will be inherited to map database tabes to classes
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
@@ -0,0 +1,81 @@
+import os
+import json
+import pytest
+import pandas as pd
+from sqlalchemy import create_engine
+from data_preparation.benchmark import synthetic_ohlcv
+from db_access import ExportToParquet, ParquetStreamExport, StockHistory
+
+CATEGORY_COLS = ["market", "segment_id", "subsector_id", "economical_sector_id"]
+
+
+STRATEGY = {"EMA_OBV": {"description": "EMA 7 e 21 e OBV",
+                        "historic_period": 20,
+                        "profit_period": 5,
+                        "profit": 0.02,
+                        "functions": {"EMA_7": {"function": "EMA", "params": {"timeperiod": 7}},
+                                      "EMA_21": {"function": "EMA", "params": {"timeperiod": 21}},
+                                      "OBV": {"function": "OBV"}}}}
+
+
+@pytest.fixture
+def strategy_file(tmp_path):
+    path = tmp_path / "strategies.json"
+    path.write_text(json.dumps(STRATEGY))
+    return str(path)
+
+
+@pytest.fixture
+def prices():
+    """Synthetic prices of 3 tickers, one DataFrame per ticker indexed by dt_price."""
+    return synthetic_ohlcv(3, 300, seed=1)
+
+
+def _write_datasets(pre_process, prices, strategy_file, dataset_path, arrow=False):
+    """Write the format_dataset output of each ticker, with obv as signal, to dataset_path/<strategy>/<ticker>.parquet."""
+    for ticker, df_raw in prices.items():
+        for strategy, strategy_def, df_tech in pre_process.calculate_strategy(strategy_file, df_raw):
+            df_model = pre_process.format_dataset(df_raw, df_tech.dropna(), strategy_def["historic_period"], 1,
+                                                  strategy_def["profit_period"], strategy_def["profit"],
+                                                  list(CATEGORY_COLS), ["obv"])
+            folder = os.path.join(dataset_path, strategy)
+            if arrow:
+                # Pipeline path
+                with ParquetStreamExport(folder, ticker) as exporter:
+                    exporter.write_table(pre_process.to_arrow_table(df_model))
+            else:
+                # Notebook path, the index of df_model is saved as __index_level_0__
+                ExportToParquet().export(df_model, folder, ticker)
+
+
+@pytest.fixture
+def write_datasets():
+    return _write_datasets
+
+
+class SqliteStockHistory(StockHistory):
+    """StockHistory reading the table prices of a SQLite database, with the columns of the real query."""
+    SQL_TEMPLATE = """
+                    select ticker, dt_price, open, close, high, low, volume,
+                        market, segment_id, subsector_id, economical_sector_id
+                    from prices
+                    where dt_price > {start_date}
+                    order by ticker, dt_price
+                   """
+    SQL_SELECT = SQL_TEMPLATE.format(start_date="'1900-01-01'")
+    SQL_SELECT_DELTA = SQL_TEMPLATE.format(start_date=":since")
+
+
+def insert_prices(str_conn, prices):
+    """Add the rows of the DataFrames of prices to the table prices, with float64 prices and text categories."""
+    engine = create_engine(str_conn)
+    try:
+        df = pd.concat(prices.values(), ignore_index=True)
+        df.to_sql("prices", engine, if_exists="append", index=False)
+    finally:
+        engine.dispose()
+
+
+@pytest.fixture
+def sqlite_conn(tmp_path):
+    return f"sqlite:///{tmp_path / 'prices.db'}"
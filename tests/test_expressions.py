@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from data_preparation.expressions import CustomColumn
+
+
+def test_evaluate_matches_pandas():
+    df = pd.DataFrame({"ema_7": [1.0, 2.0, 3.0], "ema_21": [2.0, 2.0, 0.0], "volume": [1, 2, 3]})
+    column = CustomColumn("diff", "([ema_7] - [ema_21]) / [ema_21] * -2 + [volume] / 2", use_numexpr=False)
+
+    expected = (df["ema_7"] - df["ema_21"]) / df["ema_21"] * -2 + df["volume"] / 2
+    np.testing.assert_array_equal(column.evaluate(df), expected.to_numpy())
+
+
+def test_invalid_expression():
+    with pytest.raises(ValueError):
+        CustomColumn("bad", "__import__('os')")
+
+
+def test_evaluate_from_several_threads():
+    # The same compiled column is evaluated concurrently, each thread must get its own intermediate buffers
+    column = CustomColumn("ratio", "([a] - [b]) * ([a] + [b]) / ([b] + 1)", use_numexpr=False)
+    rng = np.random.default_rng(0)
+    inputs = [{"a": rng.normal(size=5000), "b": rng.uniform(1, 2, 5000)} for _ in range(32)]
+
+    def run(data):
+        return [column.evaluate_arrays(data, 5000) for _ in range(20)]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(run, inputs))
+
+    for data, values in zip(inputs, results):
+        expected = (data["a"] - data["b"]) * (data["a"] + data["b"]) / (data["b"] + 1)
+        for result in values:
+            np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_preparation import PreProcess, PROFTABILITY_TYPE
+from data_preparation.strategy import load_strategies
+from conftest import CATEGORY_COLS
+
+
+def format_dataset_loop(pre_process, df_raw, df_tech, window_size, stride, profit_period, min_profit,
+                        cols_to_delete, signal_cols, splited_cols=None, ticker_col="ticker", date_col="dt_price"):
+    """Row by row implementation of format_dataset before the windows were built with strided views."""
+    cols_to_delete = cols_to_delete + [ticker_col, date_col]
+    splited_cols = splited_cols or []
+    cols = [col for col in df_tech.columns if col not in cols_to_delete and col not in signal_cols and col not in splited_cols]
+
+    i = 0
+    j = i + window_size
+    rows = []
+    while j < df_tech.shape[0]:
+        profit = pre_process.calculate_proftability(df_raw, df_tech[date_col].iloc[j], profit_period, PROFTABILITY_TYPE.LINEAR)
+        row = [df_tech[ticker_col].iloc[i],
+               df_tech[date_col].iloc[i],
+               df_tech[date_col].iloc[j],
+               df_tech[cols].iloc[i:j].shape,
+               df_tech[cols].iloc[i:j].values.flatten()]
+        if splited_cols:
+            row.extend([df_tech[splited_cols].iloc[i:j].shape, df_tech[splited_cols].iloc[i:j].values.flatten()])
+        row.extend([*df_tech[signal_cols].iloc[j].values, profit, int(profit >= min_profit) if profit else None])
+        rows.append(row)
+
+        i += stride
+        j = i + window_size
+
+    price_names = ["price_shape", "price_cols"] if splited_cols else []
+    df_col_names = [ticker_col, f"{date_col}_start", f"{date_col}_ends", "shape", "series", *price_names, *signal_cols, "profit", "label"]
+    df_ret = pd.DataFrame(rows, columns=df_col_names)
+    df_ret.dropna(inplace=True)
+    df_ret["label"] = df_ret["label"].astype(int)
+
+    return df_ret
+
+
+@pytest.fixture
+def tech(prices, strategy_file):
+    df_raw = prices["SYN0000"]
+    plan = load_strategies(strategy_file)["EMA_OBV"]
+    return df_raw, plan.run(df_raw)
+
+
+def assert_same_frame(expected, result):
+    assert list(result.columns) == list(expected.columns)
+    assert list(result.dtypes) == list(expected.dtypes)
+    assert result.index.equals(expected.index)
+    for col in expected.columns:
+        if col in ["series", "price_cols"]:
+            assert all(np.array_equal(a, b, equal_nan=True) and a.dtype == b.dtype for a, b in zip(expected[col], result[col]))
+        else:
+            pd.testing.assert_series_equal(result[col], expected[col])
+
+
+@pytest.mark.parametrize("stride", [1, 3, 7])
+@pytest.mark.parametrize("splited_cols", [None, ["open", "high"]])
+@pytest.mark.parametrize("signal_cols", [[], ["obv"], ["ema_21"]])
+@pytest.mark.parametrize("dropna", [True, False])
+def test_format_dataset_matches_loop(tech, stride, splited_cols, signal_cols, dropna):
+    df_raw, df_tech = tech
+    if dropna:
+        df_tech = df_tech.dropna()
+    pre_process = PreProcess()
+
+    expected = format_dataset_loop(pre_process, df_raw, df_tech, 20, stride, 5, 0.02, list(CATEGORY_COLS), signal_cols, splited_cols)
+    result = pre_process.format_dataset(df_raw, df_tech, 20, stride, 5, 0.02, list(CATEGORY_COLS), signal_cols, splited_cols)
+
+    assert result.shape[0] > 0
+    assert_same_frame(expected, result)
+
+
+def test_format_dataset_without_windows(tech):
+    df_raw, df_tech = tech
+    result = PreProcess().format_dataset(df_raw, df_tech.iloc[:20], 20, 1, 5, 0.02, list(CATEGORY_COLS), [])
+
+    assert result.shape[0] == 0
@@ -0,0 +1,41 @@
+import os
+import pandas as pd
+import pytest
+from data_preparation.benchmark import synthetic_ohlcv
+from data_preparation.online import IncrementalIndicator, OnlineScorer
+
+STRATEGY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "strategies_sample.json")
+
+
+@pytest.fixture(scope="module")
+def history():
+    return pd.concat(synthetic_ohlcv(3, 400, seed=2).values(), ignore_index=True)
+
+
+@pytest.mark.parametrize("strategy", ["EMA_7_21_OBV", "BBANDS_ADX_OBV"])
+@pytest.mark.parametrize("splited_cols", [None, ["open", "high", "low", "close", "volume"]])
+def test_online_matches_format_dataset(history, strategy, splited_cols):
+    scorer = OnlineScorer(STRATEGY_FILE, strategy, cols_to_delete=["market"], signal_cols=["obv"], splited_cols=splited_cols)
+
+    parity = scorer.check_parity(history, 40)
+
+    # The last profit_period bars have no label and can not be compared
+    assert parity["rows"] == 3 * (40 - 22)
+    assert parity["match"], parity
+
+
+def test_update_returns_one_row_per_ticker(history):
+    scorer = OnlineScorer(STRATEGY_FILE, "EMA_7_21_OBV", cols_to_delete=["market"], signal_cols=["obv"])
+    scorer.warm_up(history[history["dt_price"] < history["dt_price"].max()])
+
+    df_model = scorer.update(history[history["dt_price"] == history["dt_price"].max()])
+    inputs = scorer.inputs(df_model)
+
+    assert df_model["ticker"].tolist() == ["SYN0000", "SYN0001", "SYN0002"]
+    assert inputs.series.shape[:2] == (3, 90)
+    assert inputs.signals.shape == (3, 1)
+
+
+def test_incremental_indicator_is_abstract():
+    with pytest.raises(TypeError):
+        IncrementalIndicator(None)
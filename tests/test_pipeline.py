@@ -0,0 +1,56 @@
+import os
+import pytest
+from data_preparation.pipeline import PipelineRunner, main
+from db_access import profiler
+from conftest import CATEGORY_COLS
+
+
+@pytest.fixture
+def raw_files(tmp_path, prices):
+    raw_path = tmp_path / "raw"
+    raw_path.mkdir()
+    files = []
+    for ticker, df in prices.items():
+        files.append(str(raw_path / f"{ticker}.parquet"))
+        df.reset_index(drop=True).to_parquet(files[-1])
+    return files
+
+
+@pytest.fixture
+def clean_profiler():
+    enabled = profiler.enabled
+    profiler.reset()
+    yield profiler
+    profiler.reset()
+    profiler.enabled = enabled
+
+
+def run_stages(strategy_file, output_path, raw_files, workers):
+    profiler.reset()
+    runner = PipelineRunner(strategy_file, output_path, workers, cols_to_delete=list(CATEGORY_COLS), profile=True)
+    results = runner.run(raw_files)
+    assert all(result["status"] == "ok" for result in results)
+
+    return {(record["stage"], record["ticker"]): (record["calls"], record["rows"]) for record in profiler.records()}
+
+
+def test_worker_records_are_merged(tmp_path, strategy_file, raw_files, clean_profiler):
+    in_process = run_stages(strategy_file, str(tmp_path / "single"), raw_files, 1)
+    workers = run_stages(strategy_file, str(tmp_path / "workers"), raw_files, 2)
+
+    assert ("format_dataset", "SYN0000") in in_process
+    assert ("talib.EMA", "SYN0002") in in_process
+    assert workers == in_process
+
+
+def test_profile_option(tmp_path, strategy_file, raw_files, clean_profiler):
+    profile_file = str(tmp_path / "profile.csv")
+    code = main(["--strategies", strategy_file, "--raw-path", os.path.dirname(raw_files[0]),
+                 "--output-path", str(tmp_path / "dataset"), "--workers", "2", "--cols-to-delete", *CATEGORY_COLS,
+                 "--profile", profile_file])
+
+    assert code == 0
+    with open(profile_file, "r") as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "stage,ticker,calls,seconds,rows,bytes"
+    assert any(line.startswith("format_dataset,SYN0001,1,") for line in lines)
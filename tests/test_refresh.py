@@ -0,0 +1,63 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from db_access import ExportToParquet, StockHistory
+from db_access.refresh import RawHistoryRefresher
+from conftest import CATEGORY_COLS, SqliteStockHistory, insert_prices
+
+
+def split_prices(prices, n_new):
+    return ({ticker: df.iloc[:-n_new] for ticker, df in prices.items()},
+            {ticker: df.iloc[-n_new:] for ticker, df in prices.items()})
+
+
+def assert_same_prices(df, expected):
+    assert df.shape[0] == expected.shape[0]
+    assert (df["dt_price"].to_numpy() == expected["dt_price"].to_numpy()).all()
+    for col in StockHistory.PRICE_COLS:
+        assert df[col].dtype == "float32"
+        assert (df[col].to_numpy() == expected[col].to_numpy(dtype="float32")).all()
+    # Parquet keeps only the string categories as dictionaries, the sector ids are read back as int64
+    assert isinstance(df["market"].dtype, pd.CategoricalDtype)
+    for col in CATEGORY_COLS:
+        assert (df[col].astype(expected[col].dtype).to_numpy() == expected[col].to_numpy()).all()
+
+
+def test_append_casts_to_the_schema_of_the_file(tmp_path, prices):
+    old, new = split_prices(prices, 30)
+    folder = str(tmp_path / "raw")
+    exporter = ExportToParquet()
+    exporter.export(StockHistory.compact(old["SYN0000"].copy()), folder, "SYN0000")
+
+    # The rows of select_delta have float64 prices and object categories
+    exporter.append(new["SYN0000"].iloc[:10].reset_index(drop=True), folder, "SYN0000")
+    part_name = exporter.append(new["SYN0000"].iloc[10:].reset_index(drop=True), folder, "SYN0000")
+
+    full_name = os.path.join(folder, "SYN0000.parquet")
+    assert os.path.isdir(full_name)
+    assert sorted(os.listdir(full_name)) == ["part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+    assert part_name == os.path.join(full_name, "part-00002.parquet")
+    schema = pq.read_schema(part_name)
+    assert schema.equals(pq.read_schema(os.path.join(full_name, "part-00000.parquet")))
+    assert str(schema.field("close").type) == "float"
+    assert pa.types.is_dictionary(schema.field("market").type)
+    assert_same_prices(pd.read_parquet(full_name), prices["SYN0000"])
+
+
+def test_full_then_incremental_refresh(tmp_path, sqlite_conn, prices):
+    old, new = split_prices(prices, 25)
+    raw_path = str(tmp_path / "raw")
+    insert_prices(sqlite_conn, old)
+    refresher = RawHistoryRefresher(sqlite_conn, raw_path, reader=SqliteStockHistory(sqlite_conn))
+
+    assert refresher.refresh() == {ticker: df.shape[0] for ticker, df in old.items()}
+    assert refresher.refresh() == {}
+
+    insert_prices(sqlite_conn, new)
+    assert refresher.refresh() == {ticker: 25 for ticker in prices}
+
+    manifest = refresher.load_manifest()
+    for ticker, df in prices.items():
+        assert manifest[ticker] == df["dt_price"].max()
+        assert_same_prices(pd.read_parquet(os.path.join(raw_path, f"{ticker}.parquet")), df)
@@ -0,0 +1,85 @@
+import math
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LinearRegression
+from data_preparation import PreProcess
+from data_preparation.perpare import _rolling_ols
+
+
+def regression_loop(column: pd.Series, window_size: int, stride: int):
+    """Slope, intercept and R2 of each window fitted with LinearRegression, aligned like linear_regression_slope."""
+    array_size = math.ceil(column.shape[0]/stride)
+    slopes, intercepts, r2s = (np.full(array_size, np.nan) for _ in range(3))
+    X = np.arange(window_size).reshape(-1, 1)
+    slope_index = array_size - 1
+    for index in range(column.shape[0], window_size - 1, -stride):
+        Y = column.iloc[index-window_size:index].to_numpy()
+        model = LinearRegression().fit(X, Y)
+        slopes[slope_index] = model.coef_[0]
+        intercepts[slope_index] = model.intercept_
+        r2s[slope_index] = model.score(X, Y) if window_size > 2 else 1.0
+        slope_index -= 1
+
+    return slopes, intercepts, r2s
+
+
+@pytest.fixture(params=["price", "volume"])
+def column(request):
+    rng = np.random.default_rng(3)
+    if request.param == "price":
+        return pd.Series(20 * np.exp(np.cumsum(rng.normal(0.0002, 0.02, 400))))
+    return pd.Series(rng.integers(10**5, 10**7, 400).astype(float))
+
+
+@pytest.mark.parametrize("window_size", [2, 5, 90])
+@pytest.mark.parametrize("stride", [1, 3, 7])
+def test_rolling_ols_matches_linear_regression(column, window_size, stride):
+    expected = regression_loop(column, window_size, stride)
+    result = _rolling_ols(column.to_numpy(dtype=float), window_size, stride)
+
+    scale = column.abs().max()
+    # R2 comes from differences of the cumulative sums, windows with a tiny variance lose a few digits
+    for expected_values, values, atol in zip(expected, result, [scale * 1e-9, scale * 1e-9, 1e-6]):
+        assert values.shape == expected_values.shape
+        np.testing.assert_array_equal(np.isnan(values), np.isnan(expected_values))
+        np.testing.assert_allclose(values, expected_values, rtol=1e-7, atol=atol)
+
+
+@pytest.mark.parametrize("window_size", [2, 5, 90])
+@pytest.mark.parametrize("stride", [1, 3, 7])
+def test_linear_regression_slope_matches_linear_regression(column, window_size, stride):
+    slopes, _, _ = regression_loop(column, window_size, stride)
+    result = PreProcess().linear_regression_slope(column, window_size, stride)
+
+    np.testing.assert_allclose(result, slopes, rtol=1e-7, atol=column.abs().max() * 1e-9)
+
+
+@pytest.mark.parametrize("stride", [1, 3])
+def test_rolling_regression_columns(stride):
+    rng = np.random.default_rng(5)
+    df = pd.DataFrame({"close": 20 * np.exp(np.cumsum(rng.normal(0, 0.02, 200))),
+                       "volume": rng.integers(10**5, 10**7, 200).astype(float)},
+                      index=pd.bdate_range("2020-01-01", periods=200))
+
+    df_ret = PreProcess().rolling_regression(df, ["close", "volume"], [5, 20], stride, intercept=True, r2=True)
+
+    assert df_ret.index.equals(df.index[len(df) - 1 - (df_ret.shape[0] - 1 - np.arange(df_ret.shape[0])) * stride])
+    for col in ["close", "volume"]:
+        for window_size in [5, 20]:
+            slopes, intercepts, r2s = regression_loop(df[col], window_size, stride)
+            atol = df[col].max() * 1e-9
+            np.testing.assert_allclose(df_ret[f"coef_ang_{col}_{window_size}"], slopes, rtol=1e-7, atol=atol)
+            np.testing.assert_allclose(df_ret[f"coef_lin_{col}_{window_size}"], intercepts, rtol=1e-7, atol=atol)
+            np.testing.assert_allclose(df_ret[f"r2_{col}_{window_size}"], r2s, rtol=1e-7, atol=1e-6)
+
+
+def test_rolling_ols_nan_windows():
+    values = np.arange(20, dtype=float)
+    values[10] = np.nan
+    slopes, intercepts, r2s = _rolling_ols(values, 5, 1)
+
+    windows_with_nan = np.arange(10, 15)
+    assert np.isnan(slopes[windows_with_nan]).all()
+    assert np.isnan(slopes[:4]).all()
+    np.testing.assert_allclose(np.delete(slopes, np.r_[:4, windows_with_nan]), 1.0)
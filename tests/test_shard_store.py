@@ -0,0 +1,52 @@
+import time
+import threading
+import numpy as np
+from data_preparation import PreProcess
+from db_access import ExportToNpyShards, NpyShardDataset
+
+
+def test_shards_of_train_dataset(tmp_path, monkeypatch, prices, strategy_file, write_datasets):
+    monkeypatch.setenv("DATASET_PATH", str(tmp_path / "datasets"))
+    monkeypatch.setenv("TRAIN_DATASET", str(tmp_path / "train"))
+    pre_process = PreProcess()
+    write_datasets(pre_process, prices, strategy_file, str(tmp_path / "datasets"))
+    pre_process.create_train_test_dataset(strategy_file, 0.2, 42)
+    train_file = str(tmp_path / "train" / "EMA_OBV" / "train_data.parquet")
+
+    path = pre_process.export_dataset_shards(train_file, str(tmp_path / "shards"), "train", shard_size=100)
+    dataset = NpyShardDataset(path)
+    inputs = pre_process.read_dataset_from_parquet(train_file, as_arrays=True)
+
+    # Only the real signal columns, the index of the DataFrames is not a signal
+    assert inputs.signal_cols == ["obv"]
+    assert dataset.index["arrays"]["X_sig"]["shape"] == [len(inputs.signal_cols)]
+    assert dataset.index["arrays"]["X_ts"]["shape"] == list(inputs.series.shape[1:])
+    assert len(dataset) == inputs.labels.shape[0]
+
+    values = dataset.take(np.arange(len(dataset)), ["X_ts", "X_sig", "y"])
+    np.testing.assert_allclose(values["X_sig"], inputs.signals.astype("float32"))
+    np.testing.assert_array_equal(values["y"], inputs.labels)
+
+    (X_ts, X_sig), y = next(dataset.batches(32, shuffle=True, seed=0))
+    assert X_ts.shape[1:] == inputs.series.shape[1:] and X_sig.shape == (32, 1) and y.shape == (32,)
+
+
+def test_batches_closed_early(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = {"X_ts": rng.normal(size=(60, 5, 2)), "X_sig": rng.normal(size=(60, 1)), "y": rng.integers(0, 2, 60)}
+    dataset = NpyShardDataset(ExportToNpyShards(shard_size=25).export(arrays, str(tmp_path), "train"))
+    threads = threading.active_count()
+
+    for _ in range(5):
+        # The producer has the last batches and the end of the epoch left to put in a full queue
+        iterator = dataset.batches(10, shuffle=False, prefetch=2)
+        for _ in range(4):
+            next(iterator)
+        # Let the producer fill the queue
+        time.sleep(0.2)
+        iterator.close()
+
+    deadline = time.monotonic() + 5
+    while threading.active_count() > threads and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert threading.active_count() == threads
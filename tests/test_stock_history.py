@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+from db_access.dbo import group_by_ticker
+from conftest import CATEGORY_COLS, SqliteStockHistory, insert_prices
+
+
+@pytest.mark.parametrize("chunksize", [70, 300, 1000])
+def test_select_stream_one_ticker_at_a_time(sqlite_conn, prices, chunksize):
+    # Each ticker has 300 rows: the chunks are smaller than, equal to and larger than one ticker
+    insert_prices(sqlite_conn, prices)
+
+    tickers = list(SqliteStockHistory(sqlite_conn).select_stream(chunksize=chunksize))
+
+    assert [df["ticker"].iloc[0] for df in tickers] == list(prices.keys())
+    for df in tickers:
+        expected = prices[df["ticker"].iloc[0]]
+        assert df["ticker"].nunique() == 1
+        assert df.index.equals(pd.RangeIndex(expected.shape[0]))
+        assert (df["dt_price"].to_numpy() == expected["dt_price"].to_numpy()).all()
+        for col in SqliteStockHistory.PRICE_COLS:
+            assert df[col].dtype == "float32"
+            assert (df[col].to_numpy() == expected[col].to_numpy(dtype="float32")).all()
+        for col in CATEGORY_COLS:
+            assert isinstance(df[col].dtype, pd.CategoricalDtype)
+            assert (df[col].astype(expected[col].dtype).to_numpy() == expected[col].to_numpy()).all()
+
+
+def test_group_by_ticker_across_chunks():
+    df = pd.DataFrame({"ticker": list("AAABBBBBC"), "value": range(9)})
+    chunks = [df.iloc[0:2], df.iloc[2:2], df.iloc[2:4], df.iloc[4:6], df.iloc[6:9]]
+
+    groups = list(group_by_ticker(iter(chunks)))
+
+    assert [group["ticker"].iloc[0] for group in groups] == ["A", "B", "C"]
+    assert [group["value"].tolist() for group in groups] == [[0, 1, 2], [3, 4, 5, 6, 7], [8]]
@@ -0,0 +1,56 @@
+import json
+import numpy as np
+import pytest
+from data_preparation.strategy import load_strategies
+
+STRATEGIES = {"TAIL": {"description": "EMA, OBV, MACD, ADX, AD, RSI, candles and custom columns",
+                       "historic_period": 20,
+                       "profit_period": 5,
+                       "profit": 0.02,
+                       "functions": {"EMA_7": {"function": "EMA", "params": {"timeperiod": 7}},
+                                     "EMA_21": {"function": "EMA", "params": {"timeperiod": 21}},
+                                     "OBV": {"function": "OBV"},
+                                     "MACD": {"function": "MACD", "params": {"fastperiod": 12, "slowperiod": 26, "signalperiod": 9}},
+                                     "ADX": {"function": "ADX", "params": {"timeperiod": 14}},
+                                     "AD": {"function": "AD"},
+                                     "RSI": {"function": "RSI", "params": {"timeperiod": 14}}},
+                       "candles": ["CDLDOJI", "CDLENGULFING", "CDLHAMMER"],
+                       "custom_columns": {"ema_diff": "[ema_7] - [ema_21]",
+                                          "obv_ad": "[obv] / ([ad] + 1)"}},
+              "CUMULATIVE": {"description": "Only OBV and AD, the tail has no warmup",
+                             "historic_period": 20,
+                             "profit_period": 5,
+                             "profit": 0.02,
+                             "functions": {"OBV": {"function": "OBV"},
+                                           "AD": {"function": "AD"}}}}
+
+
+@pytest.fixture
+def plans(tmp_path):
+    path = tmp_path / "strategies.json"
+    path.write_text(json.dumps(STRATEGIES))
+    return load_strategies(str(path))
+
+
+@pytest.mark.parametrize("strategy", ["TAIL", "CUMULATIVE"])
+@pytest.mark.parametrize("n_rows", [1, 15])
+def test_run_tail_matches_full_run(plans, prices, strategy, n_rows):
+    plan = plans[strategy]
+    df_raw = prices["SYN0001"]
+    previous = plan.run(df_raw.iloc[:-n_rows])
+
+    expected = plan.run(df_raw).iloc[-n_rows:]
+    tail = plan.run_tail(df_raw, n_rows, previous)
+
+    assert list(tail.columns) == list(expected.columns)
+    assert tail.index.equals(expected.index)
+    for col in expected.columns:
+        if expected[col].dtype.kind == "f":
+            np.testing.assert_allclose(tail[col], expected[col], rtol=1e-9, atol=1e-9)
+        else:
+            assert (tail[col].to_numpy() == expected[col].to_numpy()).all()
+
+
+def test_run_tail_requires_previous_for_cumulative_indicators(plans, prices):
+    with pytest.raises(ValueError):
+        plans["CUMULATIVE"].run_tail(prices["SYN0001"], 5)
@@ -0,0 +1,26 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from data_preparation import PreProcess
+
+
+@pytest.mark.parametrize("arrow", [False, True])
+def test_index_is_not_a_feature(tmp_path, monkeypatch, prices, strategy_file, write_datasets, arrow):
+    monkeypatch.setenv("DATASET_PATH", str(tmp_path / "datasets"))
+    monkeypatch.setenv("TRAIN_DATASET", str(tmp_path / "train"))
+    pre_process = PreProcess()
+    write_datasets(pre_process, prices, strategy_file, str(tmp_path / "datasets"), arrow)
+
+    pre_process.create_train_test_dataset(strategy_file, 0.2, 42)
+
+    for file in ["train_data.parquet", "test_data.parquet"]:
+        path = str(tmp_path / "train" / "EMA_OBV" / file)
+        assert not [col for col in pq.read_schema(path).names if col.startswith("__index_level_")]
+        assert pq.read_schema(path).names[-1] == "label"
+
+        inputs = pre_process.read_dataset_from_parquet(path, as_arrays=True)
+        assert inputs.signal_cols == ["obv"]
+        assert inputs.signals.shape == (inputs.labels.shape[0], 1)
+
+        df = pre_process.read_dataset_from_parquet(path)
+        assert df.index.equals(pd.RangeIndex(df.shape[0]))